@@ -1,22 +1,152 @@
 import os
+import re
 import logging
-from typing import Optional, Any
-from langchain.agents import initialize_agent, AgentType
+from typing import Optional, Any, AsyncIterator
+import asyncio
+import hashlib
+import contextvars
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from cachetools import LRUCache
+from langchain.agents import AgentExecutor, initialize_agent, AgentType, create_openai_tools_agent
 from langchain.tools import Tool
 from langchain_openai import ChatOpenAI
-from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.callbacks import AsyncCallbackHandler, BaseCallbackHandler
+from langchain_core.messages import AIMessage, FunctionMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 
 from .tools.canvas_tools import build_canvas_tools, build_canvas_tools_react
 
 
 logger = logging.getLogger("canvas_agent")
 
+# 已知支持原生 function/tool calling 的 OpenAI 模型；其它 OpenAI 兼容模型可通过 LLM_TOOL_CALLING=true 显式开启
+_TOOL_CALLING_MODEL_RE = re.compile(r"^(gpt-4o|gpt-4\.1|gpt-4-|gpt-3\.5-turbo(-1106|-0125)?$|o[134](-|$))", re.IGNORECASE)
+
+
+def _supports_tool_calling(model: str) -> bool:
+    """判断模型是否走原生 tool calling；LLM_TOOL_CALLING=true/false 可覆盖自动检测。"""
+    override = (os.environ.get("LLM_TOOL_CALLING") or "auto").strip().lower()
+    if override in ("1", "true", "yes"):
+        return True
+    if override in ("0", "false", "no"):
+        return False
+    return bool(_TOOL_CALLING_MODEL_RE.match(model.rsplit("/", 1)[-1]))
+
+
+_OPENAI_TOOLS = "openai-tools"
+_STRUCTURED_CHAT = AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION.value
+_TOOLS_AGENT_MAX_ITERATIONS = 4
+# 注入提示的历史消息上限（约 3 轮问答），控制每轮 prefill 体积
+_HISTORY_MAX_MESSAGES = 6
+
+# 系统提示中与请求无关的规则部分；tools agent 的系统消息整体保持逐字不变，便于命中 OpenAI 提示缓存
+_SYSTEM_RULES = (
+    "- 当用户需要浏览或下载课程文件时：你必须在最终回答中原样包含这一行UI指令（不要改动任何字符）：__UI_FILE_BROWSER_CARD__{\"courseId\": <id>}__。你可以在指令前后补充简短中文说明。\n"
+    "- 当用户询问作业/DDL/截止日期时，优先调用 get_upcoming_assignments\n"
+    "- 当用户需要课程列表或你无法确定课程指代时，调用 list_my_courses\n"
+    "- 当用户询问公告/通知时，调用 get_announcements（可带或不带 course_name）\n"
+    "- 当用户需要浏览或下载课程文件时，调用 browse_course_files（优先使用 course_id；或根据课程名称/课程代码/数字后缀解析）\n"
+    "- 使用工具返回的结构化列表进行总结与排序。\n"
+    "- 回答请使用简洁中文，并包含日期/课程/作业名或公告标题等关键信息。\n"
+)
+_CURRENT_TURN = (
+    "- 当前任务：\n"
+    "<current_turn>严格根据用户本轮需求选择工具，必要时用 browse_course_files 支持从课程名称/课程代码/数字后缀解析课程ID，并返回文件浏览卡片指令。</current_turn>\n"
+)
+
+# tools agent：历史对话以真实消息注入（MessagesPlaceholder），系统消息为静态文本
+SYSTEM_MESSAGE = (
+    "你是一个面向 Canvas 学习管理平台的助理。\n"
+    "- 本轮输入之前的对话消息为历史对话（仅供参考，不要复述）。\n"
+    + _CURRENT_TURN
+    + "- 在做任何工具调用前，必须先综合历史对话的信息，思考用户本轮输入的真实目的，再决定是否以及如何调用工具。\n"
+    + _SYSTEM_RULES
+)
+
+# 模块级编译一次；系统消息以 SystemMessage 对象放入，其中的花括号（UI 指令 JSON）不参与模板解析
+PROMPT = ChatPromptTemplate.from_messages([
+    SystemMessage(content=SYSTEM_MESSAGE),
+    MessagesPlaceholder("chat_history"),
+    ("human", "{input}"),
+    MessagesPlaceholder("agent_scratchpad"),
+])
+
+
+# 按 (base_url, model, api_key 哈希, streaming) 复用 ChatOpenAI 及 tools agent（prompt | llm.bind_tools | parser），
+# 省去每次请求的客户端构造与工具 schema 序列化。工具与 Canvas Token 绑定，AgentExecutor 仍按请求组装：
+# 在共享执行器上替换 tools 会让并发请求互相串用 Token。
+_AGENT_POOL_LOCK = Lock()
+_LLM_POOL: LRUCache = LRUCache(maxsize=64)
+_TOOLS_AGENT_POOL: LRUCache = LRUCache(maxsize=64)
+
+
+def _get_llm(api_key: str, base_url: str, model: str, streaming: bool) -> tuple[tuple, ChatOpenAI]:
+    key = (base_url, model, hashlib.sha256(api_key.encode("utf-8")).hexdigest(), streaming)
+    with _AGENT_POOL_LOCK:
+        llm = _LLM_POOL.get(key)
+        if llm is None:
+            llm = ChatOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                model=model,
+                temperature=0.2,
+                streaming=streaming,
+            )
+            _LLM_POOL[key] = llm
+    return key, llm
+
+
+def _get_tools_agent(llm_key: tuple, llm: ChatOpenAI, tools: list[Tool]) -> Any:
+    # 工具 schema 只取名称/描述/参数，与具体 Token 无关，可跨请求复用
+    with _AGENT_POOL_LOCK:
+        agent = _TOOLS_AGENT_POOL.get(llm_key)
+        if agent is None:
+            agent = create_openai_tools_agent(llm, tools, PROMPT)
+            _TOOLS_AGENT_POOL[llm_key] = agent
+    return agent
+
+
+class _ParallelToolAgentExecutor(AgentExecutor):
+    """同一步返回多个工具调用时并发执行（Canvas 工具均为网络 I/O），observation 按原调用顺序返回。"""
+
+    def _perform_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager=None):  # type: ignore[override]
+        # 延迟执行：由 _iter_next_step 收齐本步全部工具调用后统一调度
+        return partial(super()._perform_agent_action, name_to_tool_map, color_mapping, agent_action, run_manager)
+
+    def _iter_next_step(self, *args: Any, **kwargs: Any):  # type: ignore[override]
+        pending: list[partial] = []
+        for item in super()._iter_next_step(*args, **kwargs):
+            if isinstance(item, partial):
+                pending.append(item)
+            else:
+                yield item
+        if len(pending) == 1:
+            yield pending[0]()
+        elif pending:
+            with ThreadPoolExecutor(max_workers=len(pending), thread_name_prefix="agent-tool") as pool:
+                futures = [pool.submit(contextvars.copy_context().run, fn) for fn in pending]
+                steps = [f.result() for f in futures]
+            yield from steps
+
 
 def _truncate(text: Optional[str], max_len: int = 2000) -> str:
     if text is None:
         return ""
-    t = str(text)
-    return t if len(t) <= max_len else (t[: max_len] + "…[truncated]")
+    if type(text) is not str:
+        text = str(text)
+    return text if len(text) <= max_len else (text[: max_len] + "…[truncated]")
+
+
+# 常见消息类型的角色名快速查表，避免逐条 getattr
+_MESSAGE_ROLES: dict[type, str] = {
+    HumanMessage: "human",
+    AIMessage: "ai",
+    SystemMessage: "system",
+    ToolMessage: "tool",
+    FunctionMessage: "function",
+}
 
 
 class AgentDebugHandler(BaseCallbackHandler):
@@ -27,6 +157,8 @@ class AgentDebugHandler(BaseCallbackHandler):
         self.request_id = request_id or "-"
 
     def on_chat_model_start(self, serialized: dict, messages, **kwargs: Any) -> None:  # type: ignore[override]
+        if not logger.isEnabledFor(logging.INFO):
+            return
         try:
             model_name = serialized.get("name") or serialized.get("id") or "chat_model"
             logger.info("[LLM] start model=%s req_id=%s", model_name, self.request_id)
@@ -35,7 +167,7 @@ class AgentDebugHandler(BaseCallbackHandler):
             for bi, batch in enumerate(batches):
                 try:
                     for mi, m in enumerate(batch):
-                        role = getattr(m, "type", m.__class__.__name__)
+                        role = _MESSAGE_ROLES.get(type(m)) or getattr(m, "type", m.__class__.__name__)
                         logger.info("[LLM] prompt[%d/%d] %s: %s req_id=%s", bi, mi, role, _truncate(m.content), self.request_id)
                 except Exception:
                     pass
@@ -43,6 +175,8 @@ class AgentDebugHandler(BaseCallbackHandler):
             logger.exception("[LLM] on_chat_model_start logging failed req_id=%s", self.request_id)
 
     def on_llm_end(self, response, **kwargs: Any) -> None:  # type: ignore[override]
+        if not logger.isEnabledFor(logging.INFO):
+            return
         try:
             generations = getattr(response, "generations", [])
             for gi, gen_list in enumerate(generations):
@@ -57,6 +191,8 @@ class AgentDebugHandler(BaseCallbackHandler):
             logger.exception("[LLM] on_llm_end logging failed req_id=%s", self.request_id)
 
     def on_tool_start(self, serialized: dict, input_str: str, **kwargs: Any) -> None:  # type: ignore[override]
+        if not logger.isEnabledFor(logging.INFO):
+            return
         try:
             name = serialized.get("name", "tool")
             logger.info("[Tool] start name=%s input=%s req_id=%s", name, _truncate(input_str), self.request_id)
@@ -64,6 +200,8 @@ class AgentDebugHandler(BaseCallbackHandler):
             pass
 
     def on_tool_end(self, output: str, **kwargs: Any) -> None:  # type: ignore[override]
+        if not logger.isEnabledFor(logging.INFO):
+            return
         try:
             logger.info("[Tool] output: %s req_id=%s", _truncate(output), self.request_id)
         except Exception:
@@ -71,6 +209,8 @@ class AgentDebugHandler(BaseCallbackHandler):
 
     # Agent actions (for ReAct-style agents)
     def on_agent_action(self, action, **kwargs: Any) -> None:  # type: ignore[override]
+        if not logger.isEnabledFor(logging.INFO):
+            return
         try:
             tool = getattr(action, "tool", "-")
             tool_input = getattr(action, "tool_input", "")
@@ -80,6 +220,8 @@ class AgentDebugHandler(BaseCallbackHandler):
             pass
 
     def on_agent_finish(self, finish, **kwargs: Any) -> None:  # type: ignore[override]
+        if not logger.isEnabledFor(logging.INFO):
+            return
         try:
             return_values = getattr(finish, "return_values", {})
             log = getattr(finish, "log", "")
@@ -89,6 +231,8 @@ class AgentDebugHandler(BaseCallbackHandler):
 
     # Chain-level tracing
     def on_chain_start(self, serialized: dict, inputs: dict, **kwargs: Any) -> None:  # type: ignore[override]
+        if not logger.isEnabledFor(logging.INFO):
+            return
         try:
             name = serialized.get("name") or serialized.get("id") or "chain"
             logger.info("[Chain] start name=%s inputs_keys=%s req_id=%s", name, list(inputs.keys()) if isinstance(inputs, dict) else type(inputs), self.request_id)
@@ -96,6 +240,8 @@ class AgentDebugHandler(BaseCallbackHandler):
             pass
 
     def on_chain_end(self, outputs: Any, **kwargs: Any) -> None:  # type: ignore[override]
+        if not logger.isEnabledFor(logging.INFO):
+            return
         try:
             out_keys = list(outputs.keys()) if isinstance(outputs, dict) else type(outputs)
             logger.info("[Chain] end outputs_keys=%s req_id=%s", out_keys, self.request_id)
@@ -116,6 +262,132 @@ class AgentDebugHandler(BaseCallbackHandler):
             pass
 
 
+class _AgentTurn:
+    """单次请求的 Agent 上下文：解析 LLM 配置、构建本次 Token 绑定的工具与系统提示，并按类型构建 Agent。"""
+
+    def __init__(
+        self,
+        user_message: str,
+        canvas_token: str,
+        llm_base_url: Optional[str] = None,
+        llm_api_key: Optional[str] = None,
+        llm_model: Optional[str] = None,
+        verbose: bool = False,
+        request_id: Optional[str] = None,
+        history: Optional[list[dict[str, str]]] = None,
+        streaming: bool = False,
+        canvas_token_hash: Optional[str] = None,
+    ) -> None:
+        resolved_llm_api_key = llm_api_key or os.environ.get("LLM_API_KEY")
+        resolved_llm_base_url = llm_base_url or os.environ.get("LLM_BASE_URL")
+        resolved_llm_model = llm_model or os.environ.get("LLM_MODEL", "gpt-4o-mini")
+
+        if not resolved_llm_api_key or not resolved_llm_base_url:
+            raise RuntimeError("LLM 基础配置缺失：请设置 LLM_API_KEY 与 LLM_BASE_URL")
+
+        canvas_base_url = os.environ.get("CANVAS_BASE_URL")
+        if not canvas_base_url:
+            raise RuntimeError("缺少 CANVAS_BASE_URL，例如 https://your-school.instructure.com")
+
+        self.user_message = user_message
+        self.verbose = verbose
+        self.request_id = request_id
+
+        self.llm_key, self.llm = _get_llm(resolved_llm_api_key, resolved_llm_base_url, resolved_llm_model, streaming)
+
+        self.tools: list[Tool] = build_canvas_tools(
+            canvas_token=canvas_token, canvas_base_url=canvas_base_url, request_id=request_id, token_hash=canvas_token_hash
+        )
+        if verbose:
+            try:
+                tool_names = ", ".join([t.name for t in self.tools])
+                logger.info("[Agent] tools: %s req_id=%s", tool_names, request_id or "-")
+            except Exception:
+                pass
+
+        # 多轮历史：tools agent 转为真实消息；structured chat 仍以 XML 包裹注入系统提示
+        self.history: list[tuple[str, str]] = []
+        for turn in (history or [])[-_HISTORY_MAX_MESSAGES:]:
+            role = str(turn.get("role", "")).strip()
+            content = str(turn.get("content", "")).strip()
+            if content:
+                self.history.append((role, content))
+        self.chat_history = [
+            AIMessage(content=content) if role in ("assistant", "ai") else HumanMessage(content=content)
+            for role, content in self.history
+        ]
+
+        # 支持原生 tool calling 的模型优先使用 OpenAI tools agent：省去结构化文本解析与 handle_parsing_errors 重试，
+        # 且同一轮可返回多个并行工具调用（OpenAI 默认开启 parallel_tool_calls），由 _ParallelToolAgentExecutor 并发执行
+        self.primary_type = _OPENAI_TOOLS if _supports_tool_calling(resolved_llm_model) else _STRUCTURED_CHAT
+
+        self.callbacks: Optional[list[BaseCallbackHandler]] = [AgentDebugHandler(request_id=request_id)] if verbose else None
+
+    def build(self, agent_type: str) -> Any:
+        if agent_type == _OPENAI_TOOLS:
+            return _ParallelToolAgentExecutor(
+                agent=_get_tools_agent(self.llm_key, self.llm, self.tools),
+                tools=self.tools,
+                verbose=self.verbose,
+                max_iterations=_TOOLS_AGENT_MAX_ITERATIONS,
+                handle_parsing_errors=True,
+            )
+        return initialize_agent(
+            tools=self.tools,
+            llm=self.llm,
+            agent=AgentType(agent_type),
+            verbose=self.verbose,
+            agent_kwargs={"system_message": self.system_message(agent_type)},
+            handle_parsing_errors=True,
+        )
+
+    def system_message(self, agent_type: str) -> str:
+        if agent_type == _OPENAI_TOOLS:
+            return SYSTEM_MESSAGE
+        history_xml = "\n".join(f"<turn role=\"{role}\">{content}</turn>" for role, content in self.history)
+        return (
+            "你是一个面向 Canvas 学习管理平台的助理。\n"
+            "- 历史对话（仅供参考，不要复述）：\n"
+            f"<chat_history>\n{history_xml}\n</chat_history>\n"
+            + _CURRENT_TURN
+            + "- 在做任何工具调用前，必须先综合 <chat_history> 的信息，思考用户本轮输入的真实目的，再决定是否以及如何调用工具。\n"
+            + _SYSTEM_RULES
+        )
+
+    def inputs(self, agent_type: str) -> dict[str, Any]:
+        if agent_type == _OPENAI_TOOLS:
+            return {"input": self.user_message, "chat_history": self.chat_history}
+        return {"input": self.user_message}
+
+    def direct_messages(self) -> list[Any]:
+        # Agent 输出为空时的兜底：复用已构建的 llm 直接回答一次，不再组装第二个 Agent
+        return [SystemMessage(content=SYSTEM_MESSAGE), *self.chat_history, HumanMessage(content=self.user_message)]
+
+    def log_start(self) -> None:
+        if self.verbose:
+            logger.info("[Agent] system_message: %s req_id=%s", _truncate(self.system_message(self.primary_type)), self.request_id or "-")
+            logger.info("[Agent] user_message: %s req_id=%s", _truncate(self.user_message), self.request_id or "-")
+            logger.info("[Agent] type=%s req_id=%s", self.primary_type, self.request_id or "-")
+
+
+def _extract_text(o: Any) -> str:
+    if isinstance(o, dict) and "output" in o:
+        return str(o["output"]) if o["output"] is not None else ""
+    return str(o) if o is not None else ""
+
+
+class _TokenQueueHandler(AsyncCallbackHandler):
+    """把 LLM 增量 token 放入队列，供 SSE 推送（工具调用轮次的空 token 忽略）。"""
+
+    def __init__(self, queue: "asyncio.Queue[Optional[str]]") -> None:
+        super().__init__()
+        self.queue = queue
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if token:
+            self.queue.put_nowait(token)
+
+
 def run_agent(
     user_message: str,
     canvas_token: str,
@@ -125,85 +397,29 @@ def run_agent(
     verbose: bool = False,
     request_id: Optional[str] = None,
     history: Optional[list[dict[str, str]]] = None,
+    canvas_token_hash: Optional[str] = None,
 ) -> str:
 	"""创建一次性 Agent 并执行用户问题，严格使用本次请求携带的 Canvas Token。"""
-	resolved_llm_api_key = llm_api_key or os.environ.get("LLM_API_KEY")
-	resolved_llm_base_url = llm_base_url or os.environ.get("LLM_BASE_URL")
-	resolved_llm_model = llm_model or os.environ.get("LLM_MODEL", "gpt-4o-mini")
-
-	if not resolved_llm_api_key or not resolved_llm_base_url:
-		raise RuntimeError("LLM 基础配置缺失：请设置 LLM_API_KEY 与 LLM_BASE_URL")
-
-	canvas_base_url = os.environ.get("CANVAS_BASE_URL")
-	if not canvas_base_url:
-		raise RuntimeError("缺少 CANVAS_BASE_URL，例如 https://your-school.instructure.com")
-
-	llm = ChatOpenAI(
-		api_key=resolved_llm_api_key,
-		base_url=resolved_llm_base_url,
-		model=resolved_llm_model,
-		temperature=0.2,
-	)
-
-	tools: list[Tool] = build_canvas_tools(canvas_token=canvas_token, canvas_base_url=canvas_base_url, request_id=request_id)
-	if verbose:
-		try:
-			tool_names = ", ".join([t.name for t in tools])
-			logger.info("[Agent] tools: %s req_id=%s", tool_names, request_id or "-")
-		except Exception:
-			pass
-
-	# 将多轮历史注入提示（XML 包裹）
-	history_blocks: list[str] = []
-	for turn in (history or []):
-		role = str(turn.get("role", "")).strip()
-		content = str(turn.get("content", "")).strip()
-		if not content:
-			continue
-		history_blocks.append(f"<turn role=\"{role}\">{content}</turn>")
-	history_xml = "\n".join(history_blocks)
-
-	system_message = (
-		"你是一个面向 Canvas 学习管理平台的助理。\n"
-		"- 历史对话（仅供参考，不要复述）：\n"
-		f"<chat_history>\n{history_xml}\n</chat_history>\n"
-		"- 当前任务：\n"
-		"<current_turn>严格根据用户本轮需求选择工具，必要时用 browse_course_files 支持从课程名称/课程代码/数字后缀解析课程ID，并返回文件浏览卡片指令。</current_turn>\n"
-		"- 在做任何工具调用前，必须先综合 <chat_history> 的信息，思考用户本轮输入的真实目的，再决定是否以及如何调用工具。\n"
-		"- 当用户需要浏览或下载课程文件时：你必须在最终回答中原样包含这一行UI指令（不要改动任何字符）：__UI_FILE_BROWSER_CARD__{\"courseId\": <id>}__。你可以在指令前后补充简短中文说明。\n"
-		"- 当用户询问作业/DDL/截止日期时，优先调用 get_upcoming_assignments\n"
-		"- 当用户需要课程列表或你无法确定课程指代时，调用 list_my_courses\n"
-		"- 当用户询问公告/通知时，调用 get_announcements（可带或不带 course_name）\n"
-		"- 当用户需要浏览或下载课程文件时，调用 browse_course_files（优先使用 course_id；或根据课程名称/课程代码/数字后缀解析）\n"
-		"- 使用工具返回的结构化列表进行总结与排序。\n"
-		"- 回答请使用简洁中文，并包含日期/课程/作业名或公告标题等关键信息。\n"
-	)
-
-	agent = initialize_agent(
-		tools=tools,
-		llm=llm,
-		agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
+	turn = _AgentTurn(
+		user_message=user_message,
+		canvas_token=canvas_token,
+		llm_base_url=llm_base_url,
+		llm_api_key=llm_api_key,
+		llm_model=llm_model,
 		verbose=verbose,
-		agent_kwargs={"system_message": system_message},
-		handle_parsing_errors=True,
+		request_id=request_id,
+		history=history,
+		canvas_token_hash=canvas_token_hash,
 	)
-	if verbose:
-		logger.info("[Agent] system_message: %s req_id=%s", _truncate(system_message), request_id or "-")
-		logger.info("[Agent] user_message: %s req_id=%s", _truncate(user_message), request_id or "-")
-		logger.info("[Agent] type=%s req_id=%s", "STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION", request_id or "-")
-
-	callbacks = [AgentDebugHandler(request_id=request_id)] if verbose else None
+	agent = turn.build(turn.primary_type)
+	turn.log_start()
+	callbacks = turn.callbacks
 
 	# Prefer invoke() to avoid deprecation of run().
-	def _extract_text(o: Any) -> str:
-		if isinstance(o, dict) and "output" in o:
-			return str(o["output"]) if o["output"] is not None else ""
-		return str(o) if o is not None else ""
-
 	try:
 		if verbose:
 			logger.info("[Agent] invoke input=%s req_id=%s", _truncate(user_message), request_id or "-")
-		output = agent.invoke({"input": user_message}, config={"callbacks": callbacks} if callbacks else None)
+		output = agent.invoke(turn.inputs(turn.primary_type), config={"callbacks": callbacks} if callbacks else None)
 		if verbose:
 			logger.info("[Agent] raw output=%s req_id=%s", str(output), request_id or "-")
 		final_text = _extract_text(output)
@@ -211,36 +427,80 @@ def run_agent(
 		# As a fallback, try deprecated run()
 		if verbose:
 			logger.exception("[Agent] invoke failed; falling back to run() req_id=%s", request_id or "-")
-		final_text = agent.run(user_message, callbacks=callbacks)  # type: ignore[arg-type]
+		final_text = agent.run(callbacks=callbacks, **turn.inputs(turn.primary_type))  # type: ignore[arg-type]
 
-	# If structured chat yields empty output, fallback to OpenAI functions agent
+	# If the agent yields empty output, ask the LLM once directly (no tools)
 	if not final_text.strip():
 		try:
 			if verbose:
-				logger.info("[Agent] empty output; fallback to OPENAI_FUNCTIONS req_id=%s", request_id or "-")
-			func_agent = initialize_agent(
-				tools=tools,
-				llm=llm,
-				agent=AgentType.OPENAI_FUNCTIONS,
-				verbose=verbose,
-				agent_kwargs={"system_message": system_message},
-				handle_parsing_errors=True,
-			)
-			try:
-				if verbose:
-					logger.info("[Agent] functions invoke input=%s req_id=%s", _truncate(user_message), request_id or "-")
-				func_out = func_agent.invoke({"input": user_message}, config={"callbacks": callbacks} if callbacks else None)
-				if verbose:
-					logger.info("[Agent] functions raw output=%s req_id=%s", str(func_out), request_id or "-")
-				final_text = _extract_text(func_out)
-			except Exception:
-				if verbose:
-					logger.exception("[Agent] functions invoke failed; trying run() req_id=%s", request_id or "-")
-				final_text = func_agent.run(user_message, callbacks=callbacks)  # type: ignore[arg-type]
+				logger.info("[Agent] empty output; fallback to direct llm.invoke req_id=%s", request_id or "-")
+			fallback_out = turn.llm.invoke(turn.direct_messages(), config={"callbacks": callbacks} if callbacks else None)
+			final_text = str(fallback_out.content or "")
 		except Exception:
 			if verbose:
-				logger.exception("[Agent] fallback to OpenAI functions failed req_id=%s", request_id or "-")
+				logger.exception("[Agent] direct llm fallback failed req_id=%s", request_id or "-")
 
 	if verbose:
 		logger.info("[Agent] final_answer: %s req_id=%s", _truncate(final_text), request_id or "-")
 	return final_text
+
+
+async def astream_agent(
+    user_message: str,
+    canvas_token: str,
+    llm_base_url: Optional[str] = None,
+    llm_api_key: Optional[str] = None,
+    llm_model: Optional[str] = None,
+    verbose: bool = False,
+    request_id: Optional[str] = None,
+    history: Optional[list[dict[str, str]]] = None,
+    canvas_token_hash: Optional[str] = None,
+) -> AsyncIterator[dict[str, str]]:
+	"""流式执行 Agent：逐个产出 {"delta": token}，结束时产出 {"answer": 完整回答}。
+
+	仅 tools agent 推送增量 token（structured chat 的 token 是 JSON 动作文本）；客户端应以最终 answer 为准。
+	"""
+	turn = _AgentTurn(
+		user_message=user_message,
+		canvas_token=canvas_token,
+		llm_base_url=llm_base_url,
+		llm_api_key=llm_api_key,
+		llm_model=llm_model,
+		verbose=verbose,
+		request_id=request_id,
+		history=history,
+		streaming=True,
+		canvas_token_hash=canvas_token_hash,
+	)
+	agent = turn.build(turn.primary_type)
+	turn.log_start()
+
+	queue: asyncio.Queue[Optional[str]] = asyncio.Queue()
+	callbacks: list[BaseCallbackHandler] = [_TokenQueueHandler(queue), *(turn.callbacks or [])]
+	task = asyncio.create_task(agent.ainvoke(turn.inputs(turn.primary_type), config={"callbacks": callbacks}))
+	task.add_done_callback(lambda _t: queue.put_nowait(None))
+	try:
+		while True:
+			token = await queue.get()
+			if token is None:
+				break
+			if turn.primary_type == _OPENAI_TOOLS:
+				yield {"delta": token}
+		final_text = _extract_text(await task)
+	finally:
+		if not task.done():
+			task.cancel()
+
+	if not final_text.strip():
+		try:
+			if verbose:
+				logger.info("[Agent] empty output; fallback to direct llm.ainvoke req_id=%s", request_id or "-")
+			fallback_out = await turn.llm.ainvoke(turn.direct_messages(), config={"callbacks": turn.callbacks} if turn.callbacks else None)
+			final_text = str(fallback_out.content or "")
+		except Exception:
+			if verbose:
+				logger.exception("[Agent] direct llm fallback failed req_id=%s", request_id or "-")
+
+	if verbose:
+		logger.info("[Agent] final_answer: %s req_id=%s", _truncate(final_text), request_id or "-")
+	yield {"answer": final_text}
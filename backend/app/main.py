@@ -1,20 +1,36 @@
 import os
 import sys
+import stat
+import mimetypes
+import json
 import logging
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 import uuid
-import time
-import requests
-from fastapi import FastAPI, HTTPException, Request
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+import anyio
+import httpx
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+from fastapi import FastAPI, Depends, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, ORJSONResponse
+from starlette.background import BackgroundTask
+from starlette.types import Scope
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
+from langchain.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache
 
-from .agent import run_agent
+from .agent import run_agent, astream_agent
 from .tools.canvas_tools import (
     CanvasClient,
+    get_client,
+    hash_token,
     list_my_courses_func,
     get_upcoming_assignments_func,
     get_announcements_func,
@@ -32,8 +48,22 @@ if not logger.handlers:
 
 # 加载环境变量（容器/本地均可使用）
 load_dotenv()
+# LOG_LEVEL=DEBUG 时额外输出逐请求的 Canvas HTTP 日志；无法识别的取值回退为 INFO
+logger.setLevel(logging.getLevelNamesMapping().get((os.getenv("LOG_LEVEL") or "INFO").strip().upper(), logging.INFO))
 
-app = FastAPI(title="Canvas AI Chat Assistant")
+# LLM 响应缓存：相同 (prompt, llm_string) 直接命中缓存，不再请求 LLM；llm_string 已包含模型与温度
+# 默认关闭：缓存以明文写入完整提示（含用户对话与 Canvas 工具输出）且不过期，需显式设置 LLM_CACHE_ENABLED=true 开启
+if (os.getenv("LLM_CACHE_ENABLED") or "false").lower() in ("1", "true", "yes"):
+	set_llm_cache(SQLiteCache(database_path=os.getenv("LLM_CACHE_DB") or ".llm_cache.db"))
+
+@asynccontextmanager
+async def _lifespan(_app: FastAPI):
+	yield
+	# 关闭文件下载共享的 HTTP 客户端（_download_client 定义见下方下载接口）
+	await _download_client.aclose()
+
+
+app = FastAPI(title="Canvas AI Chat Assistant", default_response_class=ORJSONResponse, lifespan=_lifespan)
 
 # CORS（如需限制来源，可把 * 改为你的前端域名）
 app.add_middleware(
@@ -60,8 +90,32 @@ def health_check():
 	return {"status": "ok"}
 
 
-@app.post("/api/chat", response_model=ChatResponse)
-def chat(req: ChatRequest, request: Request):
+# Agent 专用线程池 + 并发上限：不占用 FastAPI 默认线程池（静态文件等同步依赖也在其中），超出上限时快速返回 503
+_AGENT_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("AGENT_POOL_SIZE") or "16"), thread_name_prefix="agent")
+_AGENT_MAX_CONCURRENCY = int(os.getenv("AGENT_MAX_CONCURRENCY") or "32")
+_AGENT_SEM = asyncio.Semaphore(_AGENT_MAX_CONCURRENCY)
+# 所有批量请求合计最多占用全局并发上限的一半，其余名额始终留给交互式 /api/chat
+_BATCH_SEM = asyncio.Semaphore(max(1, _AGENT_MAX_CONCURRENCY // 2))
+_AGENT_QUEUE_TIMEOUT = float(os.getenv("AGENT_QUEUE_TIMEOUT") or "10")
+
+
+async def _acquire_agent_slot() -> None:
+	try:
+		await asyncio.wait_for(_AGENT_SEM.acquire(), timeout=_AGENT_QUEUE_TIMEOUT)
+	except asyncio.TimeoutError:
+		raise HTTPException(status_code=503, detail="服务繁忙，请稍后重试")
+
+
+async def _run_in_agent_pool(func: Any, **kwargs: Any) -> Any:
+	await _acquire_agent_slot()
+	try:
+		return await asyncio.get_running_loop().run_in_executor(_AGENT_POOL, functools.partial(func, **kwargs))
+	finally:
+		_AGENT_SEM.release()
+
+
+def _resolve_chat_kwargs(req: ChatRequest, request: Request) -> Dict[str, Any]:
+	"""校验聊天请求并解析 run_agent/astream_agent 所需参数。"""
 	if not req.message:
 		raise HTTPException(status_code=400, detail="缺少必要字段: message")
 
@@ -87,18 +141,28 @@ def chat(req: ChatRequest, request: Request):
 	if not llm_base_override:
 		raise HTTPException(status_code=500, detail="后端 LLM_BASE_URL 未配置且未通过头部提供")
 
-	# 运行 Agent（注意：不要打印/记录用户 Token）
+	return {
+		"user_message": req.message,
+		"canvas_token": canvas_token,
+		"canvas_token_hash": hash_token(canvas_token),
+		"llm_base_url": llm_base_override,
+		"llm_api_key": llm_key_override,
+		"llm_model": llm_model_override,
+		"verbose": agent_verbose,
+		"request_id": request_id,
+		"history": req.history or [],
+	}
+
+
+@app.post("/api/chat", response_model=ChatResponse)
+async def chat(req: ChatRequest, request: Request):
+	agent_kwargs = _resolve_chat_kwargs(req, request)
+	agent_verbose = agent_kwargs["verbose"]
+	request_id = agent_kwargs["request_id"]
+
+	# 运行 Agent（注意：不要打印/记录用户 Token）；Agent 为阻塞调用，放到专用线程池中执行以免阻塞事件循环
 	try:
-		answer = run_agent(
-			user_message=req.message,
-			canvas_token=canvas_token,
-			llm_base_url=llm_base_override,
-			llm_api_key=llm_key_override,
-			llm_model=llm_model_override,
-			verbose=agent_verbose,
-			request_id=request_id,
-			history=req.history or [],
-		)
+		answer = await _run_in_agent_pool(run_agent, **agent_kwargs)
 		if agent_verbose:
 			logger.info("[API] final_answer(forward)=%s req_id=%s", answer, request_id)
 		if not (isinstance(answer, str) and answer.strip()):
@@ -112,6 +176,93 @@ def chat(req: ChatRequest, request: Request):
 		raise HTTPException(status_code=500, detail=f"Agent 处理失败: {str(e)}")
 
 
+def _sse_event(data: Any) -> str:
+	payload = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+	return f"data: {payload}\n\n"
+
+
+@app.post("/api/chat/stream")
+async def chat_stream(req: ChatRequest, request: Request):
+	"""SSE 流式回答：依次推送 {"delta"} 增量、{"answer"} 完整回答（或 {"error"}），最后推送 [DONE]。"""
+	agent_kwargs = _resolve_chat_kwargs(req, request)
+	request_id = agent_kwargs["request_id"]
+	await _acquire_agent_slot()
+	slot_held = True
+
+	async def _release_slot() -> None:
+		# 幂等：生成器 finally 与响应结束后的 BackgroundTask 都会调用；
+		# 响应在生成器首次迭代前就被取消（客户端断开、发送前出错）时 finally 不会执行，由后者兜底释放
+		nonlocal slot_held
+		if slot_held:
+			slot_held = False
+			_AGENT_SEM.release()
+
+	async def _event_stream():
+		try:
+			async for event in astream_agent(**agent_kwargs):
+				if "answer" in event and not event["answer"].strip():
+					logger.info("[API] empty answer (stream) req_id=%s", request_id)
+					yield _sse_event({"error": "LLM 返回空响应，请检查 LLM 配置或重试"})
+					continue
+				yield _sse_event(event)
+		except Exception as e:
+			# 仅返回安全的错误信息，不泄漏 Token
+			yield _sse_event({"error": f"Agent 处理失败: {str(e)}"})
+		finally:
+			await _release_slot()
+		yield _sse_event("[DONE]")
+
+	return StreamingResponse(
+		_event_stream(),
+		media_type="text/event-stream",
+		headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+		background=BackgroundTask(_release_slot),
+	)
+
+
+class BatchChatRequest(BaseModel):
+    items: List[ChatRequest] = Field(..., min_length=1, max_length=100, description="批量问题，每项与 /api/chat 请求体相同")
+    concurrency: int = Field(8, ge=1, le=32, description="本批次最大并发数（所有批次合计不超过全局 Agent 并发上限的一半）")
+
+
+class BatchChatResult(BaseModel):
+	answer: Optional[str] = None
+	error: Optional[str] = None
+	request_id: str
+
+
+class BatchChatResponse(BaseModel):
+	results: List[BatchChatResult]
+
+
+@app.post("/api/chat/batch", response_model=BatchChatResponse)
+async def chat_batch(req: BatchChatRequest, request: Request):
+	"""批量执行 Agent：结果与输入顺序一一对应，单项失败只在该项返回 error，不影响其它项。
+	每项的 request_id 为 `<X-REQUEST-ID 或随机 ID>-<序号>`。
+	"""
+	base_request_id = request.headers.get("X-REQUEST-ID") or str(uuid.uuid4())
+	batch_sem = asyncio.Semaphore(req.concurrency)
+
+	async def _run_item(index: int, item: ChatRequest) -> BatchChatResult:
+		request_id = f"{base_request_id}-{index}"
+		try:
+			agent_kwargs = _resolve_chat_kwargs(item, request)
+			agent_kwargs["request_id"] = request_id
+			async with batch_sem, _BATCH_SEM:
+				answer = await _run_in_agent_pool(run_agent, **agent_kwargs)
+			if not (isinstance(answer, str) and answer.strip()):
+				return BatchChatResult(error="LLM 返回空响应，请检查 LLM 配置或重试", request_id=request_id)
+			return BatchChatResult(answer=answer, request_id=request_id)
+		except HTTPException as e:
+			return BatchChatResult(error=str(e.detail), request_id=request_id)
+		except Exception as e:
+			# 仅返回安全的错误信息，不泄漏 Token
+			return BatchChatResult(error=f"Agent 处理失败: {str(e)}", request_id=request_id)
+
+	results = await asyncio.gather(*[_run_item(i, item) for i, item in enumerate(req.items)])
+	return BatchChatResponse(results=list(results))
+
+
 class ToolTestRequest(BaseModel):
     tool: str = Field(..., description="工具名称: list_my_courses | get_upcoming_assignments | get_announcements")
     canvas_token: Optional[str] = Field(None, description="Canvas API Token（必填，前端需提供）")
@@ -123,7 +274,7 @@ class ToolTestResponse(BaseModel):
 
 
 @app.post("/api/tool_test", response_model=ToolTestResponse)
-def tool_test(req: ToolTestRequest, request: Request):
+async def tool_test(req: ToolTestRequest, request: Request):
 	# Canvas Token：必须由前端提供，后端不再使用环境变量兜底
 	canvas_token = (req.canvas_token or "").strip()
 	if not canvas_token:
@@ -135,17 +286,17 @@ def tool_test(req: ToolTestRequest, request: Request):
 
 	request_id = request.headers.get("X-REQUEST-ID") or str(uuid.uuid4())
 
-	client = CanvasClient(base_url=canvas_base_url, api_token=canvas_token, request_id=request_id)
+	client = get_client(canvas_base_url, canvas_token, request_id, hash_token(canvas_token))
 
 	try:
 		tool_name = (req.tool or "").strip()
 		if tool_name == "list_my_courses":
-			out = list_my_courses_func(client)
+			out = await asyncio.to_thread(list_my_courses_func, client)
 		elif tool_name == "get_upcoming_assignments":
-			out = get_upcoming_assignments_func(client)
+			out = await asyncio.to_thread(get_upcoming_assignments_func, client)
 		elif tool_name == "get_announcements":
 			name = (req.course_name or "").strip() or None
-			out = get_announcements_func(client, name)
+			out = await asyncio.to_thread(get_announcements_func, client, name)
 		else:
 			raise HTTPException(status_code=400, detail=f"未知工具名称: {tool_name}")
 		return ToolTestResponse(result=str(out or ""))
@@ -155,19 +306,48 @@ def tool_test(req: ToolTestRequest, request: Request):
 		raise HTTPException(status_code=500, detail=f"工具执行失败: {str(e)}")
 
 
-def _extract_canvas_token_from_header(request: Request) -> str:
-	"""从请求头提取 Canvas Token。"""
+def canvas_auth(request: Request) -> Tuple[str, str]:
+	"""依赖项：从请求头提取 Canvas Token，并一次性计算其哈希，返回 (token, token_hash)。
+	缓存 key、客户端复用与日志只使用 token_hash，原始 Token 仅用于下游鉴权。
+	"""
 	token = (request.headers.get("X-Canvas-Token") or "").strip()
 	if not token:
 		raise HTTPException(status_code=400, detail="缺少 X-Canvas-Token 请求头")
-	return token
+	return token, hash_token(token)
+
+
+# 课程列表/文件树短时缓存（Canvas 侧变化为小时级）；key 由 Token 哈希派生，不保存原始 Token
+_RESPONSE_CACHE_TTL = int(os.getenv("CANVAS_RESPONSE_CACHE_TTL") or "300")
+_response_cache: TTLCache = TTLCache(maxsize=1024, ttl=_RESPONSE_CACHE_TTL)
+_response_cache_lock = Lock()
+
+
+def _response_cache_key(canvas_base_url: str, token_hash: str, endpoint: str, course_id: Optional[int] = None) -> tuple:
+	return (canvas_base_url, token_hash, endpoint, course_id)
+
+
+def _response_cache_get(key: tuple) -> Optional[Dict[str, Any]]:
+	with _response_cache_lock:
+		return _response_cache.get(key)
+
+
+def _response_cache_set(key: tuple, value: Dict[str, Any]) -> None:
+	with _response_cache_lock:
+		_response_cache[key] = value
+
+
+def _set_cache_headers(response: Response) -> None:
+	response.headers["Cache-Control"] = f"private, max-age={_RESPONSE_CACHE_TTL}"
+	# 响应内容随 Token 变化，浏览器缓存需按 Token 区分，避免切换账号后读到上一个 Token 的数据
+	response.headers["Vary"] = "X-Canvas-Token"
 
 
 def _build_course_file_tree(client: CanvasClient, course_id: int) -> Dict[str, Any]:
 	"""基于 Canvas Files/Folders API 构建课程文件树。"""
-	# 列出所有文件夹与文件（按课程聚合，减少逐文件夹请求次数）
-	folders: List[Dict[str, Any]] = list(client.paginate(f"/courses/{course_id}/folders"))
-	files: List[Dict[str, Any]] = list(client.paginate(f"/courses/{course_id}/files"))
+	# 列出所有文件夹与文件（按课程聚合，减少逐文件夹请求次数）；两个分页互不依赖，并发拉取
+	folders: List[Dict[str, Any]]
+	files: List[Dict[str, Any]]
+	folders, files = client.paginate_all([f"/courses/{course_id}/folders", f"/courses/{course_id}/files"])
 
 	folder_by_id: Dict[int, Dict[str, Any]] = {}
 	children_map: Dict[Optional[int], List[int]] = {}
@@ -196,29 +376,47 @@ def _build_course_file_tree(client: CanvasClient, course_id: int) -> Dict[str, A
 	def _map_file(file_obj: Dict[str, Any]) -> Dict[str, Any]:
 		return {
 			"id": file_obj.get("id"),
+			"folder_id": int(file_obj["folder_id"]),
 			"display_name": file_obj.get("display_name") or file_obj.get("filename") or "未命名",
 			"size": file_obj.get("size"),
 			"content_type": file_obj.get("content-type") or file_obj.get("mime_class"),
 			"updated_at": file_obj.get("updated_at") or file_obj.get("modified_at"),
 		}
 
-	def _make_node(fid: int) -> Dict[str, Any]:
-		f = folder_by_id.get(fid, {})
-		node: Dict[str, Any] = {
-			"id": fid,
-			"name": f.get("name") or "",
-			"full_name": f.get("full_name") or "",
-			"locked": bool(f.get("locked", False)),
-			"hidden": bool(f.get("hidden", False)),
-			"folders": [],
-			"files": [],
-		}
-		mapped_files = [_map_file(x) for x in files_by_folder.get(fid, [])]
-		mapped_files.sort(key=lambda x: (str(x.get("display_name", "")).lower(), int(x.get("id") or 0)))
-		node["files"] = mapped_files
-		for child_id in children_map.get(fid, []) or []:
-			node["folders"].append(_make_node(child_id))
-		return node
+	def _reachable_folder_ids(root_ids: List[int]) -> List[int]:
+		"""按先序收集 root_ids 可达的全部文件夹（显式栈，避免深层目录的递归开销与 RecursionError）。"""
+		order: List[int] = []
+		seen: set[int] = set()
+		stack: List[int] = list(reversed(root_ids))
+		while stack:
+			fid = stack.pop()
+			if fid in seen:
+				continue
+			seen.add(fid)
+			order.append(fid)
+			stack.extend(reversed(children_map.get(fid, []) or []))
+		return order
+
+	def _flat_tree(root_id: Optional[int], root_ids: List[int]) -> Dict[str, Any]:
+		"""扁平结构（folders/files 两个数组 + root_id），前端按 id 还原层级，避免每个节点重复嵌套的键。"""
+		folder_ids = _reachable_folder_ids(root_ids)
+		folder_items: List[Dict[str, Any]] = []
+		file_items: List[Dict[str, Any]] = []
+		for fid in folder_ids:
+			f = folder_by_id.get(fid, {})
+			pid_raw = f.get("parent_folder_id")
+			folder_items.append({
+				"id": fid,
+				"parent_id": int(pid_raw) if pid_raw is not None else None,
+				"name": f.get("name") or "",
+				"full_name": f.get("full_name") or "",
+				"locked": bool(f.get("locked", False)),
+				"hidden": bool(f.get("hidden", False)),
+			})
+			mapped_files = [_map_file(x) for x in files_by_folder.get(fid, [])]
+			mapped_files.sort(key=lambda x: (str(x.get("display_name", "")).lower(), int(x.get("id") or 0)))
+			file_items.extend(mapped_files)
+		return {"course_id": int(course_id), "root_id": root_id, "folders": folder_items, "files": file_items}
 
 	# 选择根：parent_folder_id 为空且 context 为课程的文件夹优先
 	root_candidates = children_map.get(None, []) or []
@@ -234,47 +432,43 @@ def _build_course_file_tree(client: CanvasClient, course_id: int) -> Dict[str, A
 		root_folder_id = prefer[0] if prefer else (cands[0] if cands else root_candidates[0])
 
 	if root_folder_id is not None:
-		return {"course_id": int(course_id), "root": _make_node(root_folder_id)}
-	else:
-		# 退化：不存在显式根，构造聚合根
-		return {
-			"course_id": int(course_id),
-			"root": {
-				"id": None,
-				"name": "Course Files",
-				"full_name": "course files",
-				"locked": False,
-				"hidden": False,
-				"folders": [_make_node(fid) for fid in root_candidates],
-				"files": [],
-			},
-		}
+		return _flat_tree(root_folder_id, [root_folder_id])
+	# 退化：不存在显式根，root_id 为空，由前端把所有顶层文件夹挂到聚合根 "Course Files" 下
+	return _flat_tree(None, root_candidates)
+
+
+def _list_active_courses(client: CanvasClient) -> List[Dict[str, Any]]:
+	"""在读课程（客户端缓存），按课程代码/名称排序。"""
+	items: List[Dict[str, Any]] = []
+	for c in client.get_active_courses():
+		cid = c.get("id")
+		name = c.get("name")
+		if not cid or not name:
+			continue
+		items.append({
+			"id": int(cid),
+			"name": str(name),
+			"course_code": c.get("course_code") or c.get("code") or None,
+		})
+	# 排序：按课程代码/名称
+	items.sort(key=lambda o: (str(o.get("course_code") or ""), str(o.get("name") or "")))
+	return items
 
 
 @app.get("/api/courses")
-def list_courses(request: Request):
-	"""列出用户当前在读课程，返回 JSON：[{id,name,course_code}]。"""
-	canvas_token = _extract_canvas_token_from_header(request)
+async def list_courses(request: Request, auth: Tuple[str, str] = Depends(canvas_auth)):
+	"""列出用户当前在读课程，返回 JSON：[{id,name,course_code}]。
+	只依赖 CanvasClient 的课程列表缓存（5 分钟），不再叠加响应缓存与浏览器缓存，新选课最多 5 分钟可见。
+	"""
+	canvas_token, token_hash = auth
 	canvas_base_url = os.getenv("CANVAS_BASE_URL")
 	if not canvas_base_url:
 		raise HTTPException(status_code=500, detail="缺少 CANVAS_BASE_URL，例如 https://your-school.instructure.com")
 	request_id = request.headers.get("X-REQUEST-ID") or str(uuid.uuid4())
-	client = CanvasClient(base_url=canvas_base_url, api_token=canvas_token, request_id=request_id)
+	client = get_client(canvas_base_url, canvas_token, request_id, token_hash)
 	try:
-		items: List[Dict[str, Any]] = []
-		for c in client.paginate("/courses", params={"enrollment_state": "active"}):
-			cid = c.get("id")
-			name = c.get("name")
-			if not cid or not name:
-				continue
-			items.append({
-				"id": int(cid),
-				"name": str(name),
-				"course_code": c.get("course_code") or c.get("code") or None,
-			})
-		# 排序：按课程代码/名称
-		items.sort(key=lambda o: (str(o.get("course_code") or ""), str(o.get("name") or "")))
-		return JSONResponse(content={"courses": items})
+		items = await asyncio.to_thread(_list_active_courses, client)
+		return {"courses": items}
 	except HTTPException:
 		raise
 	except Exception as e:
@@ -282,95 +476,168 @@ def list_courses(request: Request):
 
 
 @app.get("/api/courses/{course_id}/file_tree")
-def get_course_file_tree(course_id: int, request: Request):
-	canvas_token = _extract_canvas_token_from_header(request)
+async def get_course_file_tree(course_id: int, request: Request, response: Response, auth: Tuple[str, str] = Depends(canvas_auth)):
+	canvas_token, token_hash = auth
 	canvas_base_url = os.getenv("CANVAS_BASE_URL")
 	if not canvas_base_url:
 		raise HTTPException(status_code=500, detail="缺少 CANVAS_BASE_URL，例如 https://your-school.instructure.com")
 	request_id = request.headers.get("X-REQUEST-ID") or str(uuid.uuid4())
-	client = CanvasClient(base_url=canvas_base_url, api_token=canvas_token, request_id=request_id)
+	cache_key = _response_cache_key(canvas_base_url, token_hash, "file_tree", int(course_id))
+	cached = _response_cache_get(cache_key)
+	if cached is not None:
+		_set_cache_headers(response)
+		return cached
+	client = get_client(canvas_base_url, canvas_token, request_id, token_hash)
 	try:
-		tree = _build_course_file_tree(client, int(course_id))
-		return JSONResponse(content=tree)
+		tree = await asyncio.to_thread(_build_course_file_tree, client, int(course_id))
+		_response_cache_set(cache_key, tree)
+		_set_cache_headers(response)
+		return tree
 	except HTTPException:
 		raise
 	except Exception as e:
 		raise HTTPException(status_code=500, detail=f"文件树构建失败: {str(e)}")
 
 
+def _fetch_file_download_meta(client: CanvasClient, file_id: int) -> tuple[Dict[str, Any], Optional[str]]:
+	"""获取文件元数据与下载链接（阻塞调用）。"""
+	# 元数据请求：偶发的网络错误与 429/5xx 已由会话挂载的 HTTPAdapter 退避重试，这里不再叠加重试
+	try:
+		meta_resp = client.get(f"/files/{int(file_id)}")
+		meta_resp.raise_for_status()
+		j = meta_resp.json()
+		meta: Dict[str, Any] = j if isinstance(j, dict) else {}
+	except Exception as e:
+		raise HTTPException(status_code=502, detail=f"下载失败: 元数据请求异常: {str(e)}")
+
+	# 优先使用文件对象中的 url；缺失则尝试 public_url 端点
+	url = meta.get("url")
+	if not url:
+		try:
+			pub_resp = client.get(f"/files/{int(file_id)}/public_url")
+			pub_resp.raise_for_status()
+			payload = pub_resp.json()
+			pub_json = payload if isinstance(payload, dict) else {}
+			url = pub_json.get("public_url") or url
+		except Exception:
+			pass
+	return meta, url
+
+
+# 文件下载专用的异步 HTTP 客户端（模块级复用连接，支持 HTTP/2）；Token 按请求放在请求头中，不绑定到客户端
+# 读超时按单次读取计时而非整个传输，大文件不受影响；上游停滞或连接池耗尽时 60 秒后报错，不会无限挂起
+_download_client = httpx.AsyncClient(http2=True, timeout=httpx.Timeout(60.0, connect=15.0), follow_redirects=True)
+
+# 透传给浏览器的上游响应头：长度/缓存校验便于显示进度与缓存；raw 转发时需保留 Content-Encoding
+_DOWNLOAD_FORWARD_HEADERS = ("Content-Length", "Content-Encoding", "ETag", "Last-Modified")
+
+
 @app.get("/api/files/{file_id}/download")
-def download_file(file_id: int, request: Request):
+async def download_file(file_id: int, request: Request, auth: Tuple[str, str] = Depends(canvas_auth)):
 	"""代理下载 Canvas 文件，避免在前端暴露 Token。使用 X-Canvas-Token 进行后端鉴权与下游获取。"""
-	canvas_token = _extract_canvas_token_from_header(request)
+	canvas_token, token_hash = auth
 	canvas_base_url = os.getenv("CANVAS_BASE_URL")
 	if not canvas_base_url:
 		raise HTTPException(status_code=500, detail="缺少 CANVAS_BASE_URL，例如 https://your-school.instructure.com")
 	request_id = request.headers.get("X-REQUEST-ID") or str(uuid.uuid4())
-	client = CanvasClient(base_url=canvas_base_url, api_token=canvas_token, request_id=request_id)
+	client = get_client(canvas_base_url, canvas_token, request_id, token_hash)
 	try:
-		# 元数据请求：增加轻量重试以缓解偶发 DNS/网络波动
-		last_err: Optional[Exception] = None
-		meta = {}
-		for attempt in range(3):
-			try:
-				meta_resp = client.get(f"/files/{int(file_id)}")
-				meta_resp.raise_for_status()
-				j = meta_resp.json()
-				meta = j if isinstance(j, dict) else {}
-				last_err = None
-				break
-			except requests.exceptions.RequestException as e:
-				last_err = e
-				time.sleep(0.4 * (2 ** attempt))
-			except Exception as e:
-				last_err = e
-				time.sleep(0.2 * (2 ** attempt))
-		if last_err is not None and not meta:
-			raise HTTPException(status_code=502, detail=f"下载失败: 元数据请求异常: {str(last_err)}")
-
-		# 优先使用文件对象中的 url；缺失则尝试 public_url 端点
-		url = meta.get("url")
-		if not url:
-			try:
-				pub_resp = client.get(f"/files/{int(file_id)}/public_url")
-				pub_resp.raise_for_status()
-				pub_json = pub_resp.json() if isinstance(pub_resp.json(), dict) else {}
-				url = pub_json.get("public_url") or url
-			except Exception:
-				pass
+		meta, url = await asyncio.to_thread(_fetch_file_download_meta, client, file_id)
 		if not url:
 			raise HTTPException(status_code=404, detail="文件不存在或没有可用的下载链接")
 		filename = meta.get("display_name") or meta.get("filename") or f"file_{file_id}"
-		# 直接跟随重定向并流式转发
-		dl_resp = client.session.get(url, stream=True, timeout=60)
-		if getattr(dl_resp, "status_code", 500) >= 400:
+		# 跟随重定向并以原始字节流式转发（aiter_raw 不做解码/解压，压缩体连同 Content-Encoding 原样交给调用方）
+		# 上游请求使用调用方自己的 Accept-Encoding（未提供则为 identity），上游只会返回调用方能解码的编码
+		# httpx 在跨域重定向（如 S3 预签名链接）时会自动丢弃 Authorization 头
+		dl_req = _download_client.build_request("GET", url, headers={
+			"Authorization": f"Bearer {canvas_token}",
+			"Accept-Encoding": request.headers.get("Accept-Encoding") or "identity",
+		})
+		dl_resp = await _download_client.send(dl_req, stream=True)
+		if dl_resp.status_code >= 400:
+			await dl_resp.aclose()
 			raise HTTPException(status_code=dl_resp.status_code, detail=f"下游文件下载失败（{dl_resp.status_code}）")
 		content_type = dl_resp.headers.get("Content-Type") or meta.get("content-type") or "application/octet-stream"
 		from urllib.parse import quote as _urlquote
-		disposition = f"attachment; filename*=UTF-8''{_urlquote(str(filename))}"
+		headers = {"Content-Disposition": f"attachment; filename*=UTF-8''{_urlquote(str(filename))}"}
+		for name in _DOWNLOAD_FORWARD_HEADERS:
+			value = dl_resp.headers.get(name)
+			if value:
+				headers[name] = value
 
-		def _iter_stream():
+		async def _iter_stream():
 			try:
-				for chunk in dl_resp.iter_content(chunk_size=65536):
-					if chunk:
-						yield chunk
-			except Exception:
+				async for chunk in dl_resp.aiter_raw(65536):
+					yield chunk
+			except httpx.HTTPError:
 				pass
-			finally:
-				try:
-					dl_resp.close()
-				except Exception:
-					pass
 
-		return StreamingResponse(_iter_stream(), media_type=content_type, headers={"Content-Disposition": disposition})
+		return StreamingResponse(
+			_iter_stream(),
+			media_type=content_type,
+			headers=headers,
+			background=BackgroundTask(dl_resp.aclose),
+		)
 	except HTTPException:
 		raise
 	except Exception as e:
 		raise HTTPException(status_code=500, detail=f"下载失败: {str(e)}")
 
 
+def _accepted_encodings(accept_encoding: str) -> set:
+	"""解析 Accept-Encoding，返回客户端接受的编码集合（忽略 q=0 的编码）。"""
+	accepted = set()
+	for token in accept_encoding.split(","):
+		coding, _, params = token.strip().partition(";")
+		coding = coding.strip().lower()
+		q = 1.0
+		for param in params.split(";"):
+			name, _, value = param.strip().partition("=")
+			if name.strip().lower() == "q":
+				try:
+					q = float(value)
+				except ValueError:
+					q = 0.0
+		if coding and q > 0:
+			accepted.add(coding)
+	return accepted
+
+
+class PrecompressedStaticFiles(StaticFiles):
+	"""静态文件：若存在预压缩的 .br/.gz 文件且客户端支持对应编码，则直接返回压缩版本。"""
+
+	_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+	async def get_response(self, path: str, scope: Scope) -> Response:
+		accept_encoding = ""
+		for key, value in scope.get("headers") or []:
+			if key == b"accept-encoding":
+				accept_encoding = value.decode("latin-1")
+				break
+		if accept_encoding:
+			accepted = _accepted_encodings(accept_encoding)
+			target = "index.html" if path in ("", ".") else path
+			for encoding, suffix in self._ENCODINGS:
+				if encoding not in accepted:
+					continue
+				full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, target + suffix)
+				if stat_result and stat.S_ISREG(stat_result.st_mode):
+					# 经 file_response 构造，保留 If-None-Match/If-Modified-Since 的 304 判断
+					response = self.file_response(full_path, stat_result, scope)
+					response.headers["Vary"] = "Accept-Encoding"
+					if response.status_code == 200:
+						media_type = mimetypes.guess_type(target)[0] or "text/plain"
+						if media_type.startswith("text/"):
+							media_type += "; charset=utf-8"
+						response.headers["Content-Type"] = media_type
+						response.headers["Content-Encoding"] = encoding
+					return response
+		return await super().get_response(path, scope)
+
+
 # 静态文件托管（将前端文件放在 project_root/frontend 下）
+# 仅对静态资源启用 gzip：API 中的 SSE 与文件下载流不能被压缩缓冲
 project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 frontend_dir = os.path.join(project_root, "frontend")
 if os.path.isdir(frontend_dir):
-	app.mount("/", StaticFiles(directory=frontend_dir, html=True), name="frontend")
+	app.mount("/", GZipMiddleware(PrecompressedStaticFiles(directory=frontend_dir, html=True), minimum_size=1024), name="frontend")
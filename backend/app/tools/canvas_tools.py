@@ -1,23 +1,198 @@
+import os
 import re
 import time
+import heapq
+import hashlib
 import logging
+import orjson
 import requests
+from threading import BoundedSemaphore, Lock, Thread
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial, wraps
+from cachetools import LRUCache, TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_cache import CachedSession
 from datetime import datetime, timezone
-from typing import Iterable, List, Optional, Tuple, Dict, Any
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from typing import Callable, Iterable, List, Optional, Set, Tuple, Dict, Any
 from pydantic import BaseModel, Field
 from langchain.tools import StructuredTool, Tool
 
 logger = logging.getLogger("canvas_agent")
 
+# Link 头中的 rel="next" 分页链接
+_RE_NEXT = re.compile(r'<([^>]+)>;\s*rel="next"')
+_RE_LAST = re.compile(r'<([^>]+)>;\s*rel="last"')
+_RE_TAG = re.compile(r"<[^>]+>")
+# 课程代码中的数字后缀（如 SDSC5003 -> 5003）
+_RE_CODE_TAIL = re.compile(r"(\d{3,6})$")
+
+
+def hash_token(api_token: str) -> str:
+	"""Canvas Token 的 sha256 摘要；缓存 key、客户端复用与日志标记只使用该摘要，不接触原始 Token。"""
+	return hashlib.sha256(api_token.encode("utf-8")).hexdigest()
+
+
+def _json(resp: requests.Response) -> Any:
+	# orjson 解析比标准库 json 快数倍，且解析期间释放 GIL，利于并发抓取
+	return orjson.loads(resp.content)
+
+
+def _remaining_page_urls(next_url: Optional[str], last_url: Optional[str]) -> List[str]:
+	"""由 rel="next"/rel="last" 推导剩余各页 URL；仅适用于数字页码，书签式分页返回空列表（走串行 next 链接）。"""
+	if not next_url or not last_url:
+		return []
+	next_parts = urlsplit(next_url)
+	next_query = parse_qsl(next_parts.query, keep_blank_values=True)
+	next_page = dict(next_query).get("page") or ""
+	last_page = dict(parse_qsl(urlsplit(last_url).query)).get("page") or ""
+	if not (next_page.isdigit() and last_page.isdigit()):
+		return []
+	urls: List[str] = []
+	for page in range(int(next_page), int(last_page) + 1):
+		query = urlencode([(k, str(page) if k == "page" else v) for k, v in next_query])
+		urls.append(urlunsplit(next_parts._replace(query=query)))
+	return urls
+
+
+def _build_course_index(courses: List[dict]) -> Dict[str, Any]:
+	"""by_code: 小写 course_code -> ids；by_suffix: 代码数字后缀（如 SDSC5003 -> 5003）-> ids；
+	by_name: 小写完整名称 -> ids；names_lower: [(小写名称, id)]。
+	"""
+	by_code: Dict[str, List[int]] = {}
+	by_suffix: Dict[str, List[int]] = {}
+	by_name: Dict[str, List[int]] = {}
+	names_lower: List[Tuple[str, int]] = []
+	for c in courses:
+		cid = c.get("id")
+		if not cid:
+			continue
+		cid = int(cid)
+		code = str(c.get("course_code") or c.get("code") or "")
+		if code:
+			by_code.setdefault(code.lower(), []).append(cid)
+			m = _RE_CODE_TAIL.search(code)
+			if m:
+				by_suffix.setdefault(m.group(1), []).append(cid)
+		name_lower = str(c.get("name") or "").lower()
+		if name_lower:
+			by_name.setdefault(name_lower, []).append(cid)
+		names_lower.append((name_lower, cid))
+	return {"by_code": by_code, "by_suffix": by_suffix, "by_name": by_name, "names_lower": names_lower}
+
+
+# 每个会话同时在途的 Canvas GET 数；403 限流的重试次数与退避基数（秒）
+_HTTP_MAX_IN_FLIGHT = 8
+_RATE_LIMIT_RETRIES = 3
+_RATE_LIMIT_BACKOFF = 0.5
+
+
+def _is_rate_limited(resp: requests.Response) -> bool:
+	# Canvas 并发/配额超限时返回 403，响应体为 "403 Forbidden (Rate Limit Exceeded)"
+	return resp.status_code == 403 and b"Rate Limit Exceeded" in resp.content
+
+
+class _SessionState:
+	"""同一 (base_url, Token) 跨请求共享的状态：HTTP 会话（连接池 + HTTP 缓存）、课程缓存与索引、工具预热。
+	由 get_client 按 Token 哈希池化；请求相关的信息（如 request_id）只放在每次请求的 CanvasClient 上。
+	"""
+
+	def __init__(self, api_token: str) -> None:
+		# HTTP 缓存：保存 ETag/Last-Modified，过期后以条件请求（304）复验，Link 分页头随响应一并缓存。
+		# 缓存后端为每个会话独立的内存缓存：requests-cache 的 key 不含 Authorization，跨 Token 共享会串用他人数据
+		self.session = CachedSession(
+			backend="memory",
+			cache_control=True,
+			expire_after=300,
+			urls_expire_after={"*/announcements": 30, "*/planner/items": 60},
+			allowable_methods=("GET",),
+		)
+		# 会话会被 get_client 复用，连接池放大以承载同一用户的并发请求（Agent 并行工具调用、文件树并行抓取）；
+		# GET 遇到连接错误或 429/5xx 时指数退避重试（429 遵循 Retry-After），重试耗尽后返回最后一次响应交由 raise_for_status 处理
+		adapter = HTTPAdapter(
+			pool_connections=32,
+			pool_maxsize=64,
+			max_retries=Retry(
+				total=3,
+				backoff_factor=0.3,
+				status_forcelist=[429, 500, 502, 503, 504],
+				allowed_methods=["GET"],
+				raise_on_status=False,
+			),
+		)
+		self.session.mount("https://", adapter)
+		self.session.mount("http://", adapter)
+		self.session.headers.update({
+			"Authorization": f"Bearer {api_token}",
+		})
+		# 同一 Token 同时在途的 GET 上限：分页预取、逐课程并发、工具预热与并行工具调用层层叠加，
+		# 统一在 CanvasClient._send 处限流，避免触发 Canvas 的并发限流（403 Rate Limit Exceeded）
+		self.http_sem = BoundedSemaphore(_HTTP_MAX_IN_FLIGHT)
+		# 在读课程列表缓存：(获取时刻, 课程列表)，见 CanvasClient.get_active_courses
+		self.courses_cache: Optional[Tuple[float, List[dict]]] = None
+		# 课程查找索引：(对应的课程列表对象, 索引)，课程列表刷新后重建
+		self.courses_index: Optional[Tuple[List[dict], Dict[str, Any]]] = None
+		self.courses_lock = Lock()
+		# 工具输出预热：名称 -> Future，见 CanvasClient.prefetch/take_prefetched
+		self.prefetched: Dict[str, Future] = {}
+		self.prefetch_at = 0.0
+		self.prefetch_lock = Lock()
+
+	def purge_cache(self, max_age: float = 900, max_entries: int = 500) -> None:
+		"""按存入时间淘汰 HTTP 缓存（内存后端不会自动淘汰），由后台清理线程调用。
+		不能按 expired 清理：Canvas 响应多为 max-age=0，存入即过期，但正要靠其 ETag 做 304 复验。
+		抓取线程会同时写入缓存字典：list(dict.items()) 在 GIL 下一次完成，先取快照再判断，避免迭代中字典变化报错；
+		指向已删除响应的重定向记录一并清理。清理失败只记日志，不影响请求。
+		"""
+		try:
+			cache = self.session.cache
+			responses = cache.responses
+			entries = list(responses.data.items())
+			cutoff = datetime.now(timezone.utc).timestamp() - max_age
+			stale: List[str] = []
+			fresh: List[Tuple[float, str]] = []
+			for key, resp in entries:
+				created_at = getattr(resp, "created_at", None)
+				ts = created_at.timestamp() if created_at else 0.0
+				if ts < cutoff:
+					stale.append(key)
+				else:
+					fresh.append((ts, key))
+			if len(fresh) > max_entries:
+				fresh.sort()
+				stale.extend(key for _, key in fresh[: len(fresh) - max_entries])
+			if stale:
+				responses.bulk_delete(stale)
+			# 重定向记录（别名 key -> 响应 key）只增不减，目标响应已不在缓存中的一律删除
+			dangling = [alias for alias, key in list(cache.redirects.data.items()) if key not in responses.data]
+			if dangling:
+				cache.redirects.bulk_delete(dangling)
+		except Exception as e:
+			logger.debug("[HTTP] cache purge failed: %s", e)
+
+	def close(self) -> None:
+		# 预热线程池为全局共享，只取消本会话尚未开始的预热任务
+		with self.prefetch_lock:
+			pending, self.prefetched = self.prefetched, {}
+		for fut in pending.values():
+			fut.cancel()
+		self.session.close()
+
 
 class CanvasClient:
-	def __init__(self, base_url: str, api_token: str, request_id: Optional[str] = None) -> None:
+	def __init__(
+		self,
+		base_url: str,
+		api_token: str,
+		request_id: Optional[str] = None,
+		token_hash: Optional[str] = None,
+		state: Optional[_SessionState] = None,
+	) -> None:
 		# 兼容三种输入：仅域名、到 /api、到 /api/v1
 		self.base_url = base_url.rstrip("/")
-		self.session = requests.Session()
-		self.session.headers.update({
-			"Authorization": f"Bearer {api_token}",
-		})
+		# 仅保存 Token 的哈希，用于缓存 key；原始 Token 只存在于 session 请求头中
+		self.token_hash = token_hash or hash_token(api_token)
 		self.request_id = request_id or "-"
 		# 归一化 API 根路径
 		lowered = self.base_url.lower()
@@ -27,75 +202,258 @@ class CanvasClient:
 			self.api_root = f"{self.base_url}/v1"
 		else:
 			self.api_root = f"{self.base_url}/api/v1"
-		logger.info("[HTTP] api_root=%s req_id=%s", self.api_root, self.request_id)
+		if state is None:
+			state = _SessionState(api_token)
+			logger.info("[HTTP] api_root=%s token=%s… req_id=%s", self.api_root, self.token_hash[:8], self.request_id)
+		self._state = state
+		self.session = state.session
 
 	def _url(self, path: str) -> str:
 		if not path:
 			return self.api_root
 		return f"{self.api_root}{path if path.startswith('/') else '/' + path}"
 
-	def get(self, path: str, params: Optional[dict] = None) -> requests.Response:
-		url = self._url(path)
+	def _send(self, url: str, params: Optional[dict] = None) -> requests.Response:
 		start = time.monotonic()
-		logger.info("[HTTP] GET %s params=%s req_id=%s", url, params, self.request_id)
-		resp = self.session.get(url, params=params, timeout=30)
+		logger.debug("[HTTP] GET %s params=%s req_id=%s", url, params, self.request_id)
+		sem = self._state.http_sem
+		for attempt in range(_RATE_LIMIT_RETRIES + 1):
+			# 只在单次 GET 期间占用名额（退避等待时释放），嵌套的并发抓取不会互相死锁
+			with sem:
+				resp = self.session.get(url, params=params, timeout=30)
+			if attempt == _RATE_LIMIT_RETRIES or not _is_rate_limited(resp):
+				break
+			# urllib3 Retry 只按状态码重试，403 需看响应体判断是否为限流；指数退避后重试
+			delay = _RATE_LIMIT_BACKOFF * (2 ** attempt)
+			logger.debug("[HTTP] 403 rate limited, retry in %.1fs GET %s req_id=%s", delay, url, self.request_id)
+			time.sleep(delay)
 		elapsed_ms = int((time.monotonic() - start) * 1000)
-		logger.info("[HTTP] %s GET %s elapsedMs=%d req_id=%s", getattr(resp, "status_code", "-"), url, elapsed_ms, self.request_id)
+		logger.debug("[HTTP] %s GET %s elapsedMs=%d req_id=%s", getattr(resp, "status_code", "-"), url, elapsed_ms, self.request_id)
+		return resp
+
+	def get(self, path: str, params: Optional[dict] = None) -> requests.Response:
+		return self._send(self._url(path), params)
+
+	def _get_page(self, url: str, params: Optional[dict] = None) -> requests.Response:
+		resp = self._send(url, params)
+		resp.raise_for_status()
 		return resp
 
+	@staticmethod
+	def _page_items(resp: requests.Response) -> Iterable[dict]:
+		data = _json(resp)
+		if isinstance(data, list):
+			yield from data
+		else:
+			# 某些 API 可能返回 dict
+			yield data
+
 	def paginate(self, path: str, params: Optional[dict] = None) -> Iterable[dict]:
 		params = dict(params or {})
 		params.setdefault("per_page", 100)
 		url = self._url(path)
 		while url:
-			start = time.monotonic()
-			logger.info("[HTTP] GET %s params=%s req_id=%s", url, params, self.request_id)
-			resp = self.session.get(url, params=params, timeout=30)
-			elapsed_ms = int((time.monotonic() - start) * 1000)
-			logger.info("[HTTP] %s GET %s elapsedMs=%d req_id=%s", getattr(resp, "status_code", "-"), url, elapsed_ms, self.request_id)
-			resp.raise_for_status()
-			data = resp.json()
-			if isinstance(data, list):
-				for item in data:
-					yield item
-			else:
-				# 某些 API 可能返回 dict
-				yield data
+			resp = self._get_page(url, params)
 
 			link = resp.headers.get("Link")
 			next_url = None
-			if link:
-				for part in link.split(","):
-					segs = part.split(";")
-					if len(segs) >= 2 and 'rel="next"' in segs[1]:
-						next_url = segs[0].strip()[1:-1]
-						break
-			logger.info("[HTTP] pagination next=%s req_id=%s", bool(next_url), self.request_id)
+			if link and (m := _RE_NEXT.search(link)):
+				next_url = m.group(1)
+			logger.debug("[HTTP] pagination next=%s req_id=%s", bool(next_url), self.request_id)
+
+			# 带 rel="last" 的数字页码分页：总页数已知，并发预取剩余各页并按页序产出
+			last_url = None
+			if next_url and (m := _RE_LAST.search(link)):
+				last_url = m.group(1)
+			remaining = _remaining_page_urls(next_url, last_url)
+			if remaining:
+				yield from self._page_items(resp)
+				yield from self._prefetch_pages(remaining)
+				return
+
+			yield from self._page_items(resp)
 			url = next_url
 
+	def _prefetch_pages(self, urls: List[str]) -> Iterable[dict]:
+		pool = ThreadPoolExecutor(max_workers=min(8, len(urls)), thread_name_prefix="canvas-page")
+		try:
+			# 分页链接已携带原始查询参数，无需再次附加 params
+			futures = [pool.submit(self._get_page, url) for url in urls]
+			for fut in futures:
+				yield from self._page_items(fut.result())
+		finally:
+			# 调用方提前结束迭代或出错时，取消尚未开始的预取
+			pool.shutdown(wait=False, cancel_futures=True)
+
+	def get_active_courses(self, ttl: float = 300) -> List[dict]:
+		"""在读课程列表（/courses?enrollment_state=active），在客户端上缓存 ttl 秒；返回的列表为共享对象，调用方不要修改。
+		持锁期间拉取，并发的工具调用只会触发一次分页。
+		"""
+		state = self._state
+		with state.courses_lock:
+			cached = state.courses_cache
+			if cached is not None and time.monotonic() - cached[0] < ttl:
+				return cached[1]
+			courses = list(self.paginate("/courses", params={"enrollment_state": "active"}))
+			state.courses_cache = (time.monotonic(), courses)
+			return courses
+
+	def get_active_courses_index(self, ttl: float = 300) -> Dict[str, Any]:
+		"""在读课程的查找索引（见 _build_course_index），与 get_active_courses 共用缓存，仅在课程列表刷新后重建。"""
+		courses = self.get_active_courses(ttl)
+		state = self._state
+		with state.courses_lock:
+			cached = state.courses_index
+			if cached is not None and cached[0] is courses:
+				return cached[1]
+			index = _build_course_index(courses)
+			state.courses_index = (courses, index)
+			return index
+
+	def prefetch(self, jobs: Dict[str, Callable[[], Any]], ttl: float = 120) -> None:
+		"""在共享的预热线程池中并发执行各预热任务；ttl 内重复调用不再提交，避免多轮对话反复预热。
+		线程池有界，繁忙时任务排队；排队中的任务会在 take_prefetched 时被取消，不会拖慢工具调用。
+		"""
+		state = self._state
+		with state.prefetch_lock:
+			now = time.monotonic()
+			if state.prefetch_at and now - state.prefetch_at < ttl:
+				return
+			state.prefetch_at = now
+			state.prefetched = {name: _PREFETCH_POOL.submit(job) for name, job in jobs.items()}
+
+	def take_prefetched(self, name: str) -> Any:
+		"""取出预热结果（每个结果只取一次）。
+		任务尚未开始则取消并返回 _MISSING，由调用方直接请求，避免排队等待；已在执行则等待其结果，不重复抓取。
+		未预热或预热失败同样返回 _MISSING。
+		"""
+		with self._state.prefetch_lock:
+			fut = self._state.prefetched.pop(name, None)
+		if fut is None or fut.cancel():
+			return _MISSING
+		try:
+			return fut.result()
+		except Exception:
+			return _MISSING
+
+	def paginate_all(self, paths: List[str], params: Optional[dict] = None, max_workers: int = 16) -> List[List[dict]]:
+		"""并发拉取多个分页列表（如逐课程的子资源），结果按 paths 顺序返回；总耗时取决于最慢的一路而非各路之和。"""
+		if len(paths) <= 1:
+			return [list(self.paginate(path, params)) for path in paths]
+		with ThreadPoolExecutor(max_workers=min(max_workers, len(paths)), thread_name_prefix="canvas-fanout") as pool:
+			return list(pool.map(lambda path: list(self.paginate(path, params)), paths))
+
+
+class _SessionPool(LRUCache):
+	"""LRU 淘汰时关闭被淘汰会话的连接池。"""
+
+	def popitem(self) -> Tuple[Any, _SessionState]:
+		key, state = super().popitem()
+		state.close()
+		return key, state
+
+
+_SESSIONS: _SessionPool = _SessionPool(maxsize=1024)
+# 所有会话共享的工具预热线程池：线程数不随池化会话数增长，空闲会话不占线程
+_PREFETCH_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("CANVAS_PREFETCH_WORKERS") or "12"), thread_name_prefix="canvas-prefetch")
+_SESSIONS_LOCK = Lock()
+_PURGE_INTERVAL = 60
+_purger: Optional[Thread] = None
+
+
+def _purge_session_caches() -> None:
+	"""后台线程：每 _PURGE_INTERVAL 秒清理一遍各会话的 HTTP 缓存，清理不占用请求路径。"""
+	while True:
+		time.sleep(_PURGE_INTERVAL)
+		with _SESSIONS_LOCK:
+			states = list(_SESSIONS.values())
+		for state in states:
+			state.purge_cache()
+
+
+def _start_purger() -> None:
+	# 首次创建会话时启动清理线程（调用方持有 _SESSIONS_LOCK）
+	global _purger
+	if _purger is None:
+		_purger = Thread(target=_purge_session_caches, name="canvas-cache-purge", daemon=True)
+		_purger.start()
+
+
+def get_client(base_url: str, api_token: str, request_id: Optional[str] = None, token_hash: Optional[str] = None) -> CanvasClient:
+	"""返回本次请求的 CanvasClient：按 (base_url, Token 哈希) 复用共享会话，跨请求保留 TCP/TLS 连接与各类缓存。
+	request_id 只绑定在本次返回的客户端上，并发请求之间互不覆盖；token_hash 可由调用方预先计算后传入。
+	"""
+	token_hash = token_hash or hash_token(api_token)
+	key = (base_url.rstrip("/"), token_hash)
+	with _SESSIONS_LOCK:
+		state = _SESSIONS.get(key)
+		if state is None:
+			_start_purger()
+			client = CanvasClient(base_url=base_url, api_token=api_token, request_id=request_id, token_hash=token_hash)
+			_SESSIONS[key] = client._state
+			return client
+	return CanvasClient(base_url=base_url, api_token=api_token, request_id=request_id, token_hash=token_hash, state=state)
+
 
 # --------- 工具实现 ---------
 
+_MISSING = object()
+
+
+def _memoize(fn):
+	"""工具输出短时缓存（TTL 120s），key 为 (函数名, API 根, Token 哈希, 参数)，不保存原始 Token。
+	设置 AGENT_VERBOSE=true 调试时绕过缓存，始终直连 Canvas。
+	"""
+	cache: TTLCache = TTLCache(maxsize=4096, ttl=120)
+	lock = Lock()
+
+	@wraps(fn)
+	def wrap(client: "CanvasClient", *args: Any, **kwargs: Any) -> Any:
+		if (os.environ.get("AGENT_VERBOSE") or "false").lower() in ("1", "true", "yes"):
+			return fn(client, *args, **kwargs)
+		key = (fn.__name__, client.api_root, client.token_hash, args, tuple(sorted(kwargs.items())))
+		with lock:
+			cached = cache.get(key, _MISSING)
+		if cached is not _MISSING:
+			return cached
+		out = fn(client, *args, **kwargs)
+		with lock:
+			cache[key] = out
+		return out
+
+	return wrap
+
+_FMT = "%Y-%m-%d %H:%M"
+# 本地时区无夏令时（如 UTC、Asia/Shanghai）时固定偏移即准确，缓存后省去每次解析本地时区；有夏令时则每次按日期换算
+_LOCAL_TZ = datetime.now().astimezone().tzinfo if not time.daylight else None
+
+
+def _parse_iso_fast(ts: str) -> datetime:
+	# Canvas 时间戳均为 ...Z；Python 3.11+ 的 fromisoformat 可直接解析 Z 后缀，无需先 replace
+	try:
+		return datetime.fromisoformat(ts)
+	except ValueError:
+		return datetime.fromisoformat(ts.replace("Z", "+00:00"))
+
+
 def _parse_iso(ts: Optional[str]) -> Optional[datetime]:
 	if not ts:
 		return None
 	try:
-		return datetime.fromisoformat(ts.replace("Z", "+00:00"))
+		return _parse_iso_fast(ts)
 	except Exception:
 		return None
 
 
 def _format_time(dt: Optional[datetime]) -> str:
-	if not dt:
-		return "无"
 	# 统一输出为本地时间的可读格式
-	local_dt = dt.astimezone()
-	return local_dt.strftime("%Y-%m-%d %H:%M")
+	return dt.astimezone(_LOCAL_TZ).strftime(_FMT) if dt else "无"
 
 
+# 不加 _memoize：课程列表已由 get_active_courses 缓存，再叠一层输出缓存会让结果过期时间层层累加
 def list_my_courses_func(client: CanvasClient) -> str:
     courses = []
-    for c in client.paginate("/courses", params={"enrollment_state": "active"}):
+    for c in client.get_active_courses():
         # 跳过没有 id 或 name 的条目
         if not c.get("id") or not c.get("name"):
             continue
@@ -113,84 +471,141 @@ def list_my_courses_func(client: CanvasClient) -> str:
     return "\n".join(lines)
 
 
-def get_upcoming_assignments_func(client: CanvasClient) -> str:
+def _upcoming_assignment_lines(assignments: List[dict], course_name: str) -> List[Tuple[datetime, str]]:
+	# 列表已由服务端按 bucket=future 过滤；future 含无截止日期的作业，仍需跳过
+	items: List[Tuple[datetime, str]] = []
+	for a in assignments:
+		due = _parse_iso(a.get("due_at"))
+		if not due:
+			continue
+		items.append((due, f"课程: {course_name} | 作业: {a.get('name','未命名')} | 截止: {_format_time(due)}"))
+	# 服务端 order_by=due_at 对教师/助教按最晚的覆盖截止时间排序，与返回的 due_at 不一定一致；
+	# 本地再排一次保证 heapq.merge 的前提成立（输入基本有序，Timsort 近似线性）
+	items.sort(key=lambda x: x[0])
+	return items
+
+
+# Planner 中视为“作业/DDL”的条目类型
+_PLANNER_TYPES = ("assignment", "quiz", "discussion_topic")
+
+
+def _non_student_course_ids(courses: List[dict]) -> Set[int]:
+	"""在读课程中当前用户没有学生身份（教师/助教/设计者/旁听家长等）的课程 ID。
+	Planner 只列出学生身份课程的待办，这些课程需逐课程查询；课程对象未带 enrollments 时按学生课程处理。
+	"""
+	ids: Set[int] = set()
+	for c in courses:
+		enrollments = c.get("enrollments")
+		if not c.get("id") or not enrollments:
+			continue
+		if not any(e.get("type") == "student" for e in enrollments):
+			ids.add(int(c["id"]))
+	return ids
+
+
+def _planner_assignment_lines(client: CanvasClient, exclude: Set[int]) -> List[Tuple[datetime, str]]:
+	"""通过 Planner API 一次分页拉取跨课程的待办，替代逐课程查询作业（请求数 O(课程数) -> O(1)）。
+	exclude 中的课程（改走逐课程查询）的条目跳过，避免重复。
+	"""
 	now_utc = datetime.now(timezone.utc)
 	items: List[Tuple[datetime, str]] = []
-	lines: List[str] = []
+	# start_date 取到天，同一天内的请求 URL 一致才能命中响应缓存；当天已过期的条目由下方 due 过滤剔除
+	params = {"start_date": now_utc.strftime("%Y-%m-%d")}
+	for p in client.paginate("/planner/items", params=params):
+		if p.get("plannable_type") not in _PLANNER_TYPES:
+			continue
+		if p.get("course_id") and int(p["course_id"]) in exclude:
+			continue
+		plannable = p.get("plannable") or {}
+		due = _parse_iso(plannable.get("due_at") or p.get("plannable_date"))
+		if not due or due <= now_utc:
+			continue
+		course_name = p.get("context_name") or "未知课程"
+		title = plannable.get("title") or plannable.get("name") or "未命名"
+		items.append((due, f"课程: {course_name} | 作业: {title} | 截止: {_format_time(due)}"))
+	return items
+
 
-	for course in client.paginate("/courses", params={"enrollment_state": "active"}):
+def _per_course_assignment_lines(client: CanvasClient, only: Optional[Set[int]] = None) -> List[List[Tuple[datetime, str]]]:
+	"""逐课程查询作业（only 给定时只查这些课程）；返回每门课各自（已按截止时间排好序）的列表。"""
+	courses: List[Tuple[int, str]] = []
+	for course in client.get_active_courses():
 		course_id = course.get("id")
-		course_name = course.get("name") or "未知课程"
-		if not course_id:
+		if not course_id or (only is not None and int(course_id) not in only):
 			continue
-		for a in client.paginate(f"/courses/{course_id}/assignments"):
-			due = _parse_iso(a.get("due_at"))
-			if not due or due <= now_utc:
-				continue
-			items.append((due, f"课程: {course_name} | 作业: {a.get('name','未命名')} | 截止: {_format_time(due)}"))
+		courses.append((course_id, course.get("name") or "未知课程"))
 
-	if not items:
-		return "当前没有未截止的作业。"
+	# 各课程作业互不依赖，并发抓取（网络 I/O 为主）；Session 在多线程 GET 下共享连接池
+	per_course = client.paginate_all(
+		[f"/courses/{cid}/assignments" for cid, _ in courses],
+		params={"bucket": "future", "order_by": "due_at"},
+	)
+	return [_upcoming_assignment_lines(assignments, cname) for (_cid, cname), assignments in zip(courses, per_course)]
 
-	items.sort(key=lambda x: x[0])
-	for _, line in items:
-		lines.append(line)
+
+@_memoize
+def get_upcoming_assignments_func(client: CanvasClient) -> str:
+	streams: List[List[Tuple[datetime, str]]]
+	# 非学生身份的课程不会出现在 Planner 中（Planner 对此返回 200 而非报错），这些课程单独逐课程查询
+	courses = client.get_active_courses()
+	non_student = _non_student_course_ids(courses)
+	try:
+		streams = []
+		if len(non_student) < sum(1 for c in courses if c.get("id")):
+			# Planner 基本按日期返回，sort 近似线性
+			streams.append(sorted(_planner_assignment_lines(client, non_student), key=lambda x: x[0]))
+		if non_student:
+			streams.extend(_per_course_assignment_lines(client, non_student))
+	except requests.exceptions.RequestException as e:
+		# 旧版 Canvas 等无法使用 Planner 时，回退到全部课程逐课程查询
+		logger.info("[ToolFn] planner unavailable (%s); fallback to per-course assignments req_id=%s", e.__class__.__name__, client.request_id)
+		streams = _per_course_assignment_lines(client)
+
+	# 各路均已按截止时间排序，归并即可得到全局顺序（O(N log K)）
+	lines = [line for _, line in heapq.merge(*streams, key=lambda x: x[0])]
+	if not lines:
+		return "当前没有未截止的作业。"
 	return "\n".join(lines)
 
 
-def _find_course_ids_by_name(client: CanvasClient, course_name: str) -> List[int]:
-    results: List[int] = []
-    target = course_name.strip().lower()
-    for c in client.paginate("/courses", params={"enrollment_state": "active"}):
-        name = str(c.get("name", "")).lower()
-        if target == name or target in name:
-            if c.get("id"):
-                results.append(int(c["id"]))
-    return results
+def _list_active_course_ids(client: CanvasClient) -> List[int]:
+    """在读课程 ID（基于 get_active_courses 缓存，热调用不触发分页）。"""
+    return [int(c["id"]) for c in client.get_active_courses() if c.get("id")]
 
 
 def _find_course_ids_by_hint(client: CanvasClient, hint_raw: str) -> List[int]:
     """根据用户提供的 hint（课程标题、课程代码如 SDSC5003，或代码后缀如 5003）查找课程ID。
-    匹配优先级：course_code 完整匹配 > 代码后缀匹配 > 名称包含。
+    匹配优先级：course_code 完整匹配 > 代码后缀匹配 > 名称完全一致 > 名称包含。
     """
     if not hint_raw:
         return []
     hint = hint_raw.strip()
     lowered = hint.lower()
 
-    # 采集必要字段
-    items: List[Tuple[int, str, str, str]] = []  # (id, name, course_code, short_suffix)
-    for c in client.paginate("/courses", params={"enrollment_state": "active"}):
-        cid = c.get("id")
-        if not cid:
-            continue
-        name = str(c.get("name") or "")
-        code = str(c.get("course_code") or c.get("code") or "")
-        suffix = ""
-        # 提取 code 中的数字后缀（如 SDSC5003 -> 5003）
-        if code:
-            m = re.search(r"(\d{3,6})$", code)
-            if m:
-                suffix = m.group(1)
-        items.append((int(cid), name, code, suffix))
+    index = client.get_active_courses_index()
 
     # 1) 完整匹配 course_code（不区分大小写）
-    exact: List[int] = [cid for cid, _n, code, _suf in items if code and code.lower() == lowered]
+    exact = index["by_code"].get(lowered)
     if exact:
-        return exact
+        return list(exact)
 
     # 2) 若 hint 是纯数字，优先按代码后缀匹配（避免将 5003 当作课程ID）
     if hint.isdigit():
-        tail: List[int] = [cid for cid, _n, _c, suf in items if suf and suf == hint]
+        tail = index["by_suffix"].get(hint)
         if tail:
-            return tail
+            return list(tail)
+
+    # 3) 名称完全一致时直接返回，不再被名称包含该 hint 的其它课程干扰
+    exact_name = index["by_name"].get(lowered)
+    if exact_name:
+        return list(exact_name)
 
-    # 3) 名称包含匹配
-    name_hits: List[int] = [cid for cid, name, _c, _s in items if lowered in name.lower()]
+    # 4) 名称包含匹配
+    name_hits: List[int] = [cid for name_lower, cid in index["names_lower"] if lowered in name_lower]
     if name_hits:
         return name_hits
 
-    # 4) 回退：如果是数字且前述都没有，允许将其当作课程ID尝试（但最后才用）
+    # 5) 回退：如果是数字且前述都没有，允许将其当作课程ID尝试（但最后才用）
     try:
         num = int(hint)
         return [num]
@@ -199,14 +614,17 @@ def _find_course_ids_by_hint(client: CanvasClient, hint_raw: str) -> List[int]:
 
 
 def _strip_html(html: str, max_len: int = 240) -> str:
-	# 简单去 HTML 标签
-	text = re.sub(r"<[^>]+>", " ", html or "")
-	text = re.sub(r"\s+", " ", text).strip()
+	# 简单去 HTML 标签（无 "<" 时跳过正则）；空白折叠用 str.split/join，比 re.sub 更快
+	if not html:
+		return ""
+	text = _RE_TAG.sub(" ", html) if "<" in html else html
+	text = " ".join(text.split())
 	if len(text) > max_len:
 		text = text[:max_len] + "…"
 	return text
 
 
+# 不加 _memoize：/announcements 在会话 HTTP 缓存中仅 30 秒过期（公告变化较快），再叠加输出缓存会让结果更陈旧
 def get_announcements_func(client: CanvasClient, course_name: Optional[str]) -> str:
 	context_codes: List[str] = []
 	if course_name:
@@ -216,7 +634,10 @@ def get_announcements_func(client: CanvasClient, course_name: Optional[str]) ->
 			return f"未找到匹配课程: {course_name}"
 		context_codes = [f"course_{cid}" for cid in ids]
 	else:
-		ids = [c.get("id") for c in client.paginate("/courses", params={"enrollment_state": "active"}) if c.get("id")]
+		# /announcements 要求显式 context_codes；直接取缓存的在读课程 ID，无课程时不必再请求
+		ids = _list_active_course_ids(client)
+		if not ids:
+			return "未找到相关公告。"
 		context_codes = [f"course_{cid}" for cid in ids]
 
 	params = {"per_page": 5}
@@ -228,7 +649,8 @@ def get_announcements_func(client: CanvasClient, course_name: Optional[str]) ->
 
 	resp = client.get("/announcements", params=params)
 	resp.raise_for_status()
-	data = resp.json() if isinstance(resp.json(), list) else []
+	payload = _json(resp)
+	data = payload if isinstance(payload, list) else []
 
 	if not data:
 		return "未找到相关公告。"
@@ -249,48 +671,85 @@ def get_announcements_func(client: CanvasClient, course_name: Optional[str]) ->
 
 
 
-def build_canvas_tools(canvas_token: str, canvas_base_url: str, request_id: Optional[str] = None) -> List[StructuredTool]:
-	client = CanvasClient(base_url=canvas_base_url, api_token=canvas_token, request_id=request_id)
+def _compact_tool_output(text: str, max_items: Optional[int] = 20, per_item: int = 300) -> str:
+	"""压缩交给 LLM 的工具输出：工具均按“一行一条”输出且已排好序，保留前 max_items 行（None 为不限）并截断超长行，减少 prompt 体积。"""
+	lines = (text or "").split("\n")
+	kept = lines if max_items is None else lines[:max_items]
+	out = [line if len(line) <= per_item else line[:per_item] + "…" for line in kept]
+	if len(kept) < len(lines):
+		out.append(f"（其余 {len(lines) - len(kept)} 条已省略）")
+	return "\n".join(out)
+
+
+def _prefetch_tool_outputs(client: CanvasClient) -> None:
+	"""首次调用三个常用工具之一时并发预热它们的输出（课程、作业、全部公告），后续工具调用直接取结果。
+	CANVAS_PREFETCH=false 可关闭。
+	"""
+	if (os.environ.get("CANVAS_PREFETCH") or "true").lower() in ("0", "false", "no"):
+		return
+	client.prefetch({
+		"list_my_courses": partial(list_my_courses_func, client),
+		"get_upcoming_assignments": partial(get_upcoming_assignments_func, client),
+		"get_announcements": partial(get_announcements_func, client, None),
+	})
+
+
+def _tool_output(client: CanvasClient, name: str, fn: Callable[..., str], *args: Any) -> str:
+	out = client.take_prefetched(name)
+	return fn(client, *args) if out is _MISSING else out
+
+
+def build_canvas_tools(canvas_token: str, canvas_base_url: str, request_id: Optional[str] = None, token_hash: Optional[str] = None) -> List[StructuredTool]:
+	# 延迟获取客户端：仅在工具真正被调用时才创建/取用 CanvasClient（只读取工具元数据时无需会话）
+	rid = request_id or "-"
+	_client_holder: List[CanvasClient] = []
+
+	def _client(prefetch: bool = False) -> CanvasClient:
+		# prefetch=True 仅由三个可预热的工具传入；browse_course_files、指定课程的公告不触发预热
+		if not _client_holder:
+			_client_holder.append(get_client(canvas_base_url, canvas_token, request_id, token_hash))
+		if prefetch:
+			_prefetch_tool_outputs(_client_holder[0])
+		return _client_holder[0]
 
 	def list_courses_wrapper() -> str:
 		start = time.monotonic()
-		logger.info("[ToolFn] list_my_courses start req_id=%s", client.request_id)
+		logger.info("[ToolFn] list_my_courses start req_id=%s", rid)
 		try:
-			result = list_my_courses_func(client)
-			return result
+			# 课程列表是 Agent 消歧课程名的依据，不做条数压缩
+			return _tool_output(_client(prefetch=True), "list_my_courses", list_my_courses_func)
 		except Exception as e:
-			logger.exception("[ToolFn] list_my_courses error=%s req_id=%s", str(e), client.request_id)
+			logger.exception("[ToolFn] list_my_courses error=%s req_id=%s", str(e), rid)
 			raise
 		finally:
 			elapsed_ms = int((time.monotonic() - start) * 1000)
-			logger.info("[ToolFn] list_my_courses end elapsedMs=%d req_id=%s", elapsed_ms, client.request_id)
+			logger.info("[ToolFn] list_my_courses end elapsedMs=%d req_id=%s", elapsed_ms, rid)
 
 	def upcoming_assignments_wrapper() -> str:
 		start = time.monotonic()
-		logger.info("[ToolFn] get_upcoming_assignments start req_id=%s", client.request_id)
+		logger.info("[ToolFn] get_upcoming_assignments start req_id=%s", rid)
 		try:
-			result = get_upcoming_assignments_func(client)
-			return result
+			# 作业列表覆盖整个学期且工具不支持按课程筛选，只截断超长行、不限条数，否则较远的 DDL 无从查询
+			return _compact_tool_output(_tool_output(_client(prefetch=True), "get_upcoming_assignments", get_upcoming_assignments_func), max_items=None)
 		except Exception as e:
-			logger.exception("[ToolFn] get_upcoming_assignments error=%s req_id=%s", str(e), client.request_id)
+			logger.exception("[ToolFn] get_upcoming_assignments error=%s req_id=%s", str(e), rid)
 			raise
 		finally:
 			elapsed_ms = int((time.monotonic() - start) * 1000)
-			logger.info("[ToolFn] get_upcoming_assignments end elapsedMs=%d req_id=%s", elapsed_ms, client.request_id)
+			logger.info("[ToolFn] get_upcoming_assignments end elapsedMs=%d req_id=%s", elapsed_ms, rid)
 
 	def get_announcements_wrapper(course_name: Optional[str] = None) -> str:
 		start = time.monotonic()
 		name = course_name.strip() if course_name else None
-		logger.info("[ToolFn] get_announcements start args.course_name=%s req_id=%s", name, client.request_id)
+		logger.info("[ToolFn] get_announcements start args.course_name=%s req_id=%s", name, rid)
 		try:
-			result = get_announcements_func(client, name)
-			return result
+			return _compact_tool_output(_tool_output(_client(prefetch=True), "get_announcements", get_announcements_func, None) if not name else get_announcements_func(_client(), name))
 		except Exception as e:
-			logger.exception("[ToolFn] get_announcements error=%s req_id=%s", str(e), client.request_id)
+			logger.exception("[ToolFn] get_announcements error=%s req_id=%s", str(e), rid)
 			raise
 		finally:
 			elapsed_ms = int((time.monotonic() - start) * 1000)
-			logger.info("[ToolFn] get_announcements end elapsedMs=%d req_id=%s", elapsed_ms, client.request_id)
+			logger.info("[ToolFn] get_announcements end elapsedMs=%d req_id=%s", elapsed_ms, rid)
 
 	class _EmptyInput(BaseModel):
 		"""空输入模型，用于无参数工具。"""
@@ -308,7 +767,7 @@ def build_canvas_tools(canvas_token: str, canvas_base_url: str, request_id: Opti
 		start = time.monotonic()
 		resolved_id: Optional[int] = None
 		try:
-			logger.info("[ToolFn] browse_course_files.start args=%s req_id=%s", {"course_id": course_id, "course_name": course_name, "course_hint": course_hint}, client.request_id)
+			logger.info("[ToolFn] browse_course_files.start args=%s req_id=%s", {"course_id": course_id, "course_name": course_name, "course_hint": course_hint}, rid)
 			if course_id:
 				resolved_id = int(course_id)
 			else:
@@ -316,7 +775,7 @@ def build_canvas_tools(canvas_token: str, canvas_base_url: str, request_id: Opti
 				hint = (course_hint or course_name or "").strip()
 				if not hint:
 					return "请提供 course_id 或 course_name/course_hint"
-				ids = _find_course_ids_by_hint(client, hint)
+				ids = _find_course_ids_by_hint(_client(), hint)
 				if not ids:
 					return f"未找到匹配课程: {hint}"
 				if len(ids) > 1:
@@ -326,14 +785,14 @@ def build_canvas_tools(canvas_token: str, canvas_base_url: str, request_id: Opti
 				resolved_id = int(ids[0])
 			# 返回前端 UI 指令：仅当解析出唯一课程ID时（卡片形式，前端解析后插入到对话）
 			directive = f"__UI_FILE_BROWSER_CARD__{{\"courseId\": {resolved_id}}}__"
-			logger.info("[ToolFn] browse_course_files.directive=%s req_id=%s", directive, client.request_id)
+			logger.info("[ToolFn] browse_course_files.directive=%s req_id=%s", directive, rid)
 			return directive
 		except Exception as e:
-			logger.exception("[ToolFn] browse_course_files error=%s req_id=%s", str(e), client.request_id)
+			logger.exception("[ToolFn] browse_course_files error=%s req_id=%s", str(e), rid)
 			raise
 		finally:
 			elapsed_ms = int((time.monotonic() - start) * 1000)
-			logger.info("[ToolFn] browse_course_files end elapsedMs=%d req_id=%s", elapsed_ms, client.request_id)
+			logger.info("[ToolFn] browse_course_files end elapsedMs=%d req_id=%s", elapsed_ms, rid)
 
 	tools = [
 		StructuredTool.from_function(
@@ -373,37 +832,47 @@ def build_canvas_tools(canvas_token: str, canvas_base_url: str, request_id: Opti
 	return tools
 
 
-def build_canvas_tools_react(canvas_token: str, canvas_base_url: str, request_id: Optional[str] = None) -> List[Tool]:
+def build_canvas_tools_react(canvas_token: str, canvas_base_url: str, request_id: Optional[str] = None, token_hash: Optional[str] = None) -> List[Tool]:
 	"""为 ReAct/ChatAgent 构造单参数工具（字符串输入）。"""
-	client = CanvasClient(base_url=canvas_base_url, api_token=canvas_token, request_id=request_id)
+	# 与 build_canvas_tools 相同，延迟获取客户端
+	rid = request_id or "-"
+	_client_holder: List[CanvasClient] = []
+
+	def _client(prefetch: bool = False) -> CanvasClient:
+		# prefetch=True 仅由三个可预热的工具传入；browse_course_files、指定课程的公告不触发预热
+		if not _client_holder:
+			_client_holder.append(get_client(canvas_base_url, canvas_token, request_id, token_hash))
+		if prefetch:
+			_prefetch_tool_outputs(_client_holder[0])
+		return _client_holder[0]
 
 	def list_courses_react(_: str = "") -> str:
 		start = time.monotonic()
-		logger.info("[ToolFn] list_my_courses(start,react) req_id=%s", client.request_id)
+		logger.info("[ToolFn] list_my_courses(start,react) req_id=%s", rid)
 		try:
-			return list_my_courses_func(client)
+			return _tool_output(_client(prefetch=True), "list_my_courses", list_my_courses_func)
 		finally:
 			elapsed_ms = int((time.monotonic() - start) * 1000)
-			logger.info("[ToolFn] list_my_courses(end,react) elapsedMs=%d req_id=%s", elapsed_ms, client.request_id)
+			logger.info("[ToolFn] list_my_courses(end,react) elapsedMs=%d req_id=%s", elapsed_ms, rid)
 
 	def upcoming_assignments_react(_: str = "") -> str:
 		start = time.monotonic()
-		logger.info("[ToolFn] get_upcoming_assignments(start,react) req_id=%s", client.request_id)
+		logger.info("[ToolFn] get_upcoming_assignments(start,react) req_id=%s", rid)
 		try:
-			return get_upcoming_assignments_func(client)
+			return _tool_output(_client(prefetch=True), "get_upcoming_assignments", get_upcoming_assignments_func)
 		finally:
 			elapsed_ms = int((time.monotonic() - start) * 1000)
-			logger.info("[ToolFn] get_upcoming_assignments(end,react) elapsedMs=%d req_id=%s", elapsed_ms, client.request_id)
+			logger.info("[ToolFn] get_upcoming_assignments(end,react) elapsedMs=%d req_id=%s", elapsed_ms, rid)
 
 	def get_announcements_react(course_name: str = "") -> str:
 		start = time.monotonic()
 		name = course_name.strip() if course_name else None
-		logger.info("[ToolFn] get_announcements(start,react) args.course_name=%s req_id=%s", name, client.request_id)
+		logger.info("[ToolFn] get_announcements(start,react) args.course_name=%s req_id=%s", name, rid)
 		try:
-			return get_announcements_func(client, name)
+			return _tool_output(_client(prefetch=True), "get_announcements", get_announcements_func, None) if not name else get_announcements_func(_client(), name)
 		finally:
 			elapsed_ms = int((time.monotonic() - start) * 1000)
-			logger.info("[ToolFn] get_announcements(end,react) elapsedMs=%d req_id=%s", elapsed_ms, client.request_id)
+			logger.info("[ToolFn] get_announcements(end,react) elapsedMs=%d req_id=%s", elapsed_ms, rid)
 
 	return [
 		Tool(